@@ -24,6 +24,18 @@ with open(os.path.join(dirname,'config.yaml'), 'r', encoding='utf-8') as f:
             LOG_LEVEL = check_exist(data['Env'] ,'log_level','Env')
             LOG_EXPIRE = check_exist(data['Env'] ,'log_expire','Env')
             TMDB_API = check_exist(data['Env'] ,'tmdb_api','Env')
+            #可选项，未填写时使用默认值
+            TRANSPORT = data['Env'].get('transport') or {}
+            RETRY = data['Env'].get('retry') or {}
+            DATA_PATH = data['Env'].get('data_path','default')
+            PERSON_CACHE = data['Env'].get('person_cache') or {}
+            GUID_INDEX = data['Env'].get('guid_index') or {}
+            PIPELINE = data['Env'].get('pipeline') or {}
+            PAGE_SIZE = data['Env'].get('page_size',500)
+            BATCH = data['Env'].get('batch') or {}
+            TMDB_RATE = data['Env'].get('tmdb_rate') or {}
+            CONCURRENCY = data['Env'].get('concurrency') or {}
+            WEBHOOK = data['Env'].get('webhook') or {}
         SYNC_TASK_LIST = check_exist(data ,'Synctask','conf')
     except:
         raise ConfigError('请检查config.yaml文件')
\ No newline at end of file
@@ -1,13 +1,13 @@
 import asyncio
 import time
-import aiohttp
 from util import Util
+from util.transport import transport
 
 class Douban(Util):
     def __init__(self) -> None:
         self.sem = asyncio.Semaphore(1)
         
-        self.session = aiohttp.ClientSession()
+        self.session = transport.session('douban')
         super().__init__()
 
     async def query(self, path, method=None, headers=None, data=None, json=None, msg: str = None):
@@ -180,7 +180,8 @@ class DoubanApi():
     _session = None
 
     def __init__(self):
-        self._session = aiohttp.ClientSession()
+        #和其它上游一样使用共用的连接池，由transport统一关闭
+        self._session = transport.session('douban')
 
     @classmethod
     def __sign(cls, url: str, ts: int, method='GET') -> str:
@@ -506,7 +507,3 @@ class DoubanApi():
         清空LRU缓存
         """
         self.__invoke.cache_clear()
-
-    def __del__(self):
-        if self._session:
-            self._session.close()
\ No newline at end of file
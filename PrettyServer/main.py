@@ -1,21 +1,43 @@
 import asyncio
 import traceback
 import warnings
-import aiohttp
+from functools import partial
 from pytz_deprecation_shim import PytzUsageWarning
 from server.server import get_server
 from server.embyserver import Embyserver
 from task.synctask import SyncTask
 from util.log import log
+from util.transport import transport
+from util.metrics import metrics
+from util.events import bus
+from util.tmdb import Tmdb
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from conf.conf import CONCURRENT_NUM,SYNC_TASK_LIST
+from conf.conf import SYNC_TASK_LIST,GUID_INDEX,WEBHOOK
+
+#常驻的后台任务(webhook，websocket)，保留引用避免被回收
+background = set()
+
+def keep(task:asyncio.Task):
+    """
+        保留后台任务的引用，任务异常退出时记录日志
+    """
+    def done(task):
+        background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.critical(f'后台任务异常退出：{task.exception()!r}')
+    background.add(task)
+    task.add_done_callback(done)
+    return task
 
 async def init_server_task(server,scheduler:AsyncIOScheduler):
     if server.roletask.is_run:
         scheduler.add_job(server.roletask.run,trigger=CronTrigger.from_crontab(server.roletask.crontab))
     if server.sorttask.is_run:
         scheduler.add_job(server.sorttask.run,trigger=CronTrigger.from_crontab(server.sorttask.crontab))
+        if server.sorttask.incremental and server.sorttask.full_crontab:
+            scheduler.add_job(server.sorttask.run,args=[True],
+                              trigger=CronTrigger.from_crontab(server.sorttask.full_crontab))
     if server.scantask.is_run:
         await server.scantask.run(scheduler)
     if isinstance(server,Embyserver):
@@ -24,24 +46,71 @@ async def init_server_task(server,scheduler:AsyncIOScheduler):
         if server.titletask.is_run:
             scheduler.add_job(server.titletask.run,trigger=CronTrigger.from_crontab(server.titletask.crontab))
 
+def subscribe_events(server,sync_tasks):
+    """
+        websocket推送的事件交给对应任务，只处理变化的条目
+    """
+    if isinstance(server,Embyserver):
+        tasks = (server.sorttask,server.titletask,server.mergetask)
+    else:
+        tasks = (server.sorttask,server.roletask)
+    for t in tasks:
+        if t.is_run:
+            bus.subscribe(f'{server.name}.library_changed',t.on_items)
+    #plex扫描完成后增量排序该库
+    if not isinstance(server,Embyserver) and server.sorttask.is_run:
+        bus.subscribe(f'{server.name}.scan_finished',server.sorttask.on_scan_finished)
+    for t in sync_tasks:
+        if server is t.plex or server is t.emby:
+            bus.subscribe(f'{server.name}.userdata_changed',partial(t.on_userdata,server))
+
+async def start_webhook(sync_tasks):
+    #只有启用webhook时才需要fastapi，uvicorn
+    import uvicorn
+    import reciver
+    for t in sync_tasks:
+        reciver.register(t)
+    config = uvicorn.Config(reciver.app,host=WEBHOOK.get('host','0.0.0.0'),
+                            port=WEBHOOK.get('port',8765),log_level='warning')
+    server = uvicorn.Server(config)
+    log.info(f'webhook已启动，监听端口{config.port}')
+    return keep(asyncio.create_task(server.serve()))
+
 async def main():
     try:
         warnings.filterwarnings('ignore', category=PytzUsageWarning)
         scheduler = AsyncIOScheduler()
         log.info('初始化中.....')
-        tmdb_session = aiohttp.ClientSession()
-        sem = asyncio.Semaphore(CONCURRENT_NUM)
-        servers = await get_server(tmdb_session,sem)
+        tmdb = Tmdb(transport.session('tmdb'))
+        servers = await get_server(tmdb)
         for server in servers:
             await init_server_task(server,scheduler)
+        sync_tasks = []
+        #webhook必须设置token，否则任何人都能触发同步
+        webhook = WEBHOOK.get('run') and WEBHOOK.get('token')
+        if WEBHOOK.get('run') and not webhook:
+            log.error('webhook未设置token，不启动webhook')
+        #启用webhook后观看进度由事件实时同步，轮询只作为兜底
+        poll_minutes = WEBHOOK.get('poll_minutes',30) if webhook else 1
         for task in SYNC_TASK_LIST:
             t = SyncTask(task,servers)
             if t.is_run:
+                sync_tasks.append(t)
+                await t.build_index()
+                scheduler.add_job(t.build_index,args=[True],trigger='interval',
+                                  hours=GUID_INDEX.get('rebuild_hours',24))
                 if t.first:
                     await t.synctask()
                 log.info(f'{t.name} 初始化同步参数')
                 await t.cronsync()
-                scheduler.add_job(t.cronsync, trigger='interval',minutes=1)
+                scheduler.add_job(t.cronsync, trigger='interval',minutes=poll_minutes)
+        if webhook and sync_tasks:
+            await start_webhook(sync_tasks)
+        for server in servers:
+            if server.socket is not None:
+                subscribe_events(server,sync_tasks)
+                keep(asyncio.create_task(server.socket.run()))
+        scheduler.add_job(metrics.report, trigger='interval',minutes=10)
         scheduler.start()
         log.info('启动完成，开始调度任务')
         while True:
@@ -52,7 +121,7 @@ async def main():
         scheduler.remove_all_jobs()
         for server in servers:
             await server.close()
-        await tmdb_session.close()
+        await transport.close()
         tasks = asyncio.all_tasks(loop=asyncio.get_running_loop())
         for t in tasks:
             t.cancel()
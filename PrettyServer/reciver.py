@@ -1,9 +1,70 @@
-from fastapi import FastAPI,Request
+import hmac
+import json
+from fastapi import FastAPI,Request,HTTPException
+from util.log import log
+from conf.conf import WEBHOOK
 
 app = FastAPI()
 
+#plex webhook中需要同步的事件
+PLEX_EVENTS = ('media.scrobble','media.stop')
+#emby webhook/通知中需要同步的事件，新旧版本名称不同
+EMBY_EVENTS = ('playback.stop','item.markplayed','PlaybackStop','MarkPlayed','UserDataSaved')
 
-@app.post("/")
-async def root(request: Request):
-    data = await request.form()
-    
\ No newline at end of file
+#plex webhook会发送服务器上所有用户的事件，只处理该账户的，1为服务器所有者
+PLEX_ACCOUNT = WEBHOOK.get('plex_account',1)
+
+#服务器名称 -> (服务器, [同步任务])
+_routes = {}
+
+def register(task):
+    """
+        登记同步任务，收到其中任一服务器的事件时交给该任务处理
+    """
+    for server in (task.plex,task.emby):
+        _routes.setdefault(server.name,(server,[]))[1].append(task)
+
+async def _plex_event(request:Request):
+    #plex以multipart表单发送，json在payload字段中
+    form = await request.form()
+    payload = json.loads(form.get('payload') or '{}')
+    account = (payload.get('Account') or {}).get('id')
+    if str(account) != str(PLEX_ACCOUNT):
+        return payload.get('event'),None
+    item = (payload.get('Metadata') or {}).get('ratingKey')
+    return payload.get('event'),item
+
+async def _emby_event(request:Request):
+    #emby新版webhook发送json，旧版插件以表单发送，json在data字段中
+    if request.headers.get('content-type','').startswith('application/json'):
+        payload = await request.json()
+    else:
+        form = await request.form()
+        payload = json.loads(form.get('data') or '{}')
+    event = payload.get('Event') or payload.get('NotificationType')
+    item = (payload.get('Item') or {}).get('Id') or payload.get('ItemId')
+    return event,item,(payload.get('User') or {}).get('Id') or payload.get('UserId')
+
+@app.post("/webhook/{server_name}")
+async def webhook(server_name:str,request:Request,token:str=''):
+    if not token or not hmac.compare_digest(token,str(WEBHOOK.get('token') or '')):
+        raise HTTPException(status_code=403,detail='token错误')
+    route = _routes.get(server_name)
+    if route is None:
+        raise HTTPException(status_code=404,detail=f'{server_name} 没有参与同步任务')
+    server,tasks = route
+    if server.type == 'plex':
+        event,item = await _plex_event(request)
+        events = PLEX_EVENTS
+    else:
+        event,item,user = await _emby_event(request)
+        events = EMBY_EVENTS
+        #只处理登录用户自己的事件
+        if user and user != getattr(server,'userid',None):
+            item = None
+    if event not in events or not item:
+        return {'status':'ignored'}
+    log.debug(f'{server_name}：收到webhook {event} {item}')
+    for task in tasks:
+        task.on_event(server,event,item)
+    return {'status':'accepted'}
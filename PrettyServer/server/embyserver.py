@@ -1,9 +1,25 @@
-import aiohttp
+import asyncio
 from util.util import Util
 from util.log import log
-from util.exception import MediaTypeError,AsyncError,InvalidParams
+from util.transport import transport
+from util.match import index_by
+from util.batch import BatchLoader
+from conf.conf import PAGE_SIZE
+from util.exception import MediaTypeError,AsyncError,InvalidParams,FailRequest
 from datetime import datetime
 
+#批量获取单个条目时请求的字段，edit会原样提交，所以要包含完整编辑数据里所有可编辑的字段
+EDIT_FIELDS = ("Overview","Genres","GenreItems","Tags","TagItems","Studios","People","ProviderIds",
+               "SortName","ForcedSortName","SortIndexNumber","SortParentIndexNumber",
+               "OriginalTitle","LockedFields","LockData","Taglines","ProductionLocations","PremiereDate",
+               "ProductionYear","EndDate","DateCreated","OfficialRating","CustomRating","CommunityRating",
+               "CriticRating","DisplayOrder","AirDays","AirTime","Status","ExternalUrls","RemoteTrailers",
+               "PreferredMetadataLanguage","PreferredMetadataCountryCode","Etag","Path","ParentId",
+               "Video3DFormat","Album","AlbumArtists","ArtistItems","Composers","UserDataLastPlayedDate")
+#未指定字段时，列表默认请求的字段
+FIELDS = ("UserData","OriginalTitle","Etag","SortName","ForcedSortName","ProviderIds",
+          "RecursiveItemCount","RunTimeTicks","UserDataLastPlayedDate")
+
 class Embyserver(Util):
     def __init__(self,emby_url,emby_token=None,username=None,password=None) -> None:
         if username and password:
@@ -17,10 +33,32 @@ class Embyserver(Util):
             self.url += '/emby'
         self.type = 'emby'
         self._server = self
+        #多个条目详情合并成/Users/{uid}/Items?Ids=a,b,c一次获取
+        self.itemloader = BatchLoader(f'emby_items({self.url})',self._fetchmany)
+        #多个刮削ID搜索合并成一次AnyProviderIdEquals=tmdb.1,imdb.2,...，再按ProviderIds分发
+        self.guidloader = BatchLoader(f'emby_guids({self.url})',self._searchmany)
+
+    async def _fetchmany(self,ids:list):
+        payload = {
+            'Ids': ','.join(ids),
+            'Fields': ','.join(EDIT_FIELDS)
+        }
+        url = self.bulidurl(f'/Users/{self.userid}/Items',payload)
+        data = await self.query(url,msg='请求失败，请检查网络或ekey')
+        result = {}
+        for item in data.get('Items') or []:
+            result[item.get('Id')] = item
+        #批量查询没有返回的条目(如部分版本的演员)，逐个获取
+        for id in ids:
+            if id not in result:
+                try:
+                    result[id] = await self.query(f'/Users/{self.userid}/Items/{id}',
+                                                  msg='请求失败，请检查网络或ekey')
+                except FailRequest:
+                    pass
+        return result
 
     async def login(self):
-        if not hasattr(self,'session'):
-            self.session = aiohttp.ClientSession()
         header = {'x-emby-authorization':
             'Emby UserId="python",'
             'Client="python",'
@@ -58,27 +96,9 @@ class Embyserver(Util):
         return librarys
 
     async def close(self):
-        if hasattr(self,"session"):
-            await self.session.close()
+        await transport.close(self.url)
 
-    async def guidsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
-        if not hasattr(self,'userid'):
-            await self.login()
-        path = f'/Items'
-        search_key = ''
-        search_key += 'tmdb.'+ tmdb if tmdb else ''
-        search_key += ',tvdb.'+ tvdb if tvdb else ''
-        search_key += ',imdb.'+ imdb if imdb else ''
-        payload = {
-            'UserId':self.userid,
-            'Recursive': True,
-            'AnyProviderIdEquals': search_key,
-            #"Fields":"UserData,OriginalTitle,Etag,SortName,ForcedSortName,ProviderIds,RecursiveItemCount,RunTimeTicks"
-            "Fields":"UserData,ProviderIds,UserDataLastPlayedDate",
-            'IncludeItemTypes': "Movie,Series"
-        }
-        url = self.bulidurl(path,payload)
-        data = await self.query(url,msg='请求失败，搜索未完成')
+    def _searchresult(self,data):
         emby_medias = []
         if data.get('Items'):
             for item in data.get('Items'):
@@ -88,30 +108,185 @@ class Embyserver(Util):
                     emby_medias.append(Show(item,self._server))
         return emby_medias
 
-    async def hub_continue(self):
-        if not hasattr(self,'userid'):
-            await self.login()
+    async def build_index(self):
+        """
+            全量重建刮削ID索引
+        """
+        items = []
+        for lb in await self.library():
+            if lb.CollectionType not in (None,"movies","tvshows"):
+                continue
+            async for item in lb.iter_items(Recursive=True,ParentId=lb.Id,
+                                            IncludeItemTypes="Movie,Series",
+                                            **lb.projection(["ProviderIds"])):
+                ids = {k.lower():v for k,v in (item.get('ProviderIds') or {}).items()}
+                items.append((item.get('Id'),item.get('Type').lower(),ids))
+        self.guidindex.rebuild(items)
+        log.info(f'Emby({self.name})：刮削ID索引重建完成，共{len(items)}个条目')
+
+    async def _indexsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
+        hits = self.guidindex.lookup(tmdb=tmdb,tvdb=tvdb,imdb=imdb)
+        if not hits:
+            return []
+        ids = [item for item,_ in hits]
         payload = {
-            'Recursive':True,
+            'Ids': ','.join(ids),
             "Fields":"UserData,ProviderIds,UserDataLastPlayedDate"
         }
-        path = self.bulidurl(f'/Users/{self.userid}/Items/Resume',payload)
-        data = await self._server.query(path)
+        url = self.bulidurl(f'/Users/{self.userid}/Items',payload)
+        data = await self.query(url,msg='请求失败，搜索未完成')
+        emby_medias = self._searchresult(data)
+        #索引中已被删除的条目
+        found = {m.Id for m in emby_medias}
+        for item in ids:
+            if item not in found:
+                self.guidindex.remove(item)
+        return emby_medias
+
+    @staticmethod
+    def _provider_ids(ids:dict) -> set:
+        """
+            {'Tmdb':..,'Imdb':'tt123',..} -> {('tmdb','..'),('imdb','123')}，imdb只比较数字，和plex一致
+        """
+        keys = set()
+        for k,v in (ids or {}).items():
+            k = k.lower()
+            if k not in ('tmdb','tvdb','imdb') or not v:
+                continue
+            if k == 'imdb':
+                v = ''.join(ch for ch in str(v) if ch.isdigit())
+            keys.add((k,str(v)))
+        return keys
+
+    async def _searchmany(self,keys:list):
+        """
+            keys: [(tmdb,tvdb,imdb)]，一次搜索全部刮削ID，返回{key: [条目数据]}
+        """
+        search_key = []
+        for tmdb,tvdb,imdb in keys:
+            for provider,pid in (('tmdb',tmdb),('tvdb',tvdb),('imdb',imdb)):
+                if pid:
+                    search_key.append(f'{provider}.{pid}')
+        payload = {
+            'UserId':self.userid,
+            'Recursive': True,
+            'AnyProviderIdEquals': ','.join(dict.fromkeys(search_key)),
+            "Fields":"UserData,ProviderIds,UserDataLastPlayedDate",
+            'IncludeItemTypes': "Movie,Series"
+        }
+        url = self.bulidurl(f'/Items',payload)
+        data = await self.query(url,msg='请求失败，搜索未完成')
+        items = [(item,self._provider_ids(item.get('ProviderIds'))) for item in data.get('Items') or []]
+        result = {}
+        for key in keys:
+            wanted = self._provider_ids(dict(zip(('tmdb','tvdb','imdb'),key)))
+            result[key] = [item for item,ids in items if ids & wanted]
+        return result
+
+    async def guidsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
+        if not hasattr(self,'userid'):
+            await self.login()
+        emby_medias = await self._indexsearch(tmdb=tmdb,tvdb=tvdb,imdb=imdb)
+        if emby_medias:
+            return emby_medias
+        if not (tmdb or tvdb or imdb):
+            return []
+        items = await self.guidloader.load((tmdb,tvdb,imdb))
+        emby_medias = self._searchresult({'Items':items})
+        for media in emby_medias:
+            self.guidindex.add(media.Id,media.Type.lower(),
+                               tmdb=media.tmdbid,imdb=media.imdbid,tvdb=media.tvdbid)
+        return emby_medias
+
+    async def get_item(self,id):
+        """
+            按Id获取单个电影或单集(带用户数据)，其它类型返回None
+        """
+        if not hasattr(self,'userid'):
+            await self.login()
+        item = await self.itemloader.load(id)
+        if item is None:
+            raise FailRequest('请求失败，请检查网络或ekey',404)
+        if item.get('Type').lower() == 'movie':
+            media = Movie(item,self._server)
+        elif item.get('Type').lower() == 'episode':
+            media = Episode(item,self._server)
+        else:
+            return None
+        if (item.get('UserData') or {}).get("LastPlayedDate"):
+            media.LastPlayedDate = datetime.fromisoformat(
+                item['UserData'].get("LastPlayedDate")[:-2])
+        return media
+
+    async def get_medias(self,ids:list):
+        """
+            按Id批量获取电影，剧集，季，返回对应的对象，其它类型和不存在的条目忽略
+        """
+        if not hasattr(self,'userid'):
+            await self.login()
+        items = await asyncio.gather(*[self.itemloader.load(id) for id in ids])
         medias = []
-        for item in data.get('Items'):
-            if item['UserData'].get("LastPlayedDate"):
+        for item in items:
+            if item is None:
+                continue
+            type = (item.get('Type') or '').lower()
+            if type == 'movie':
+                medias.append(Movie(item,self._server))
+            elif type == 'series':
+                medias.append(Show(item,self._server))
+            elif type == 'season':
+                medias.append(Season(item,self._server))
+        return medias
+
+    async def _pages(self,path:str,payload:dict,since:datetime=None,page_size:int=None,msg:str=None):
+        """
+            按最后观看时间倒序分页获取，返回带LastPlayedDate的电影和单集；
+            since为None时只取一页，否则取到早于since为止
+        """
+        page_size = page_size or (PAGE_SIZE if since is not None else 20)
+        start = 0
+        medias = []
+        while True:
+            page = dict(payload,StartIndex=start,Limit=page_size)
+            data = await self._server.query(self.bulidurl(path,page),msg=msg)
+            items = data.get('Items') or []
+            for item in items:
+                if not (item.get('UserData') or {}).get("LastPlayedDate"):
+                    continue
                 if item.get('Type').lower() == 'movie':
                     media = Movie(item,self._server)
                 elif item.get('Type').lower() == 'episode':
                     media = Episode(item,self._server)
+                else:
+                    continue
                 media.LastPlayedDate = datetime.fromisoformat(
                     item['UserData'].get("LastPlayedDate")[:-2])
+                if since is not None and media.LastPlayedDate <= since:
+                    return medias
                 medias.append(media)
-        if not medias:
+            start += len(items)
+            if since is None or len(items) < page_size:
+                return medias
+
+    async def hub_continue(self,since:datetime=None):
+        """
+            since：同步任务的继续观看时间(utc)，给出时分页获取，只返回之后的条目
+        """
+        if not hasattr(self,'userid'):
+            await self.login()
+        payload = {
+            'Recursive':True,
+            "Fields":"UserData,ProviderIds,UserDataLastPlayedDate"
+        }
+        medias = await self._pages(f'/Users/{self.userid}/Items/Resume',payload,since)
+        if not medias and since is None:
             log.warning(f'Emby({self.name})无继续观看记录')
         return medias
 
-    async def history(self,**kwargs):
+    async def history(self,since:datetime=None,**kwargs):
+        """
+            since：同步任务的已观看时间(utc)，给出时分页获取，只返回之后的条目，默认最近20条
+        """
         if not hasattr(self,'userid'):
             await self.login()
         if kwargs:
@@ -122,30 +297,20 @@ class Embyserver(Util):
                 'SortBy':'DatePlayed',
                 'SortOrder':'Descending',
                 'Recursive':True,
-                'Limit':20,
                 "Fields":"UserData,ProviderIds,UserDataLastPlayedDate"
             }
-        path = self.bulidurl(f'/Users/{self.userid}/Items',payload)
-        data = await self._server.query(path,msg='请求历史失败')
-        medias = []
-        if data.get('TotalRecordCount') == 0:
+            if since is not None:
+                #只要用户数据在这之后变过的条目
+                payload['MinDateLastSavedForUser'] = since.isoformat() + 'Z'
+        medias = await self._pages(f'/Users/{self.userid}/Items',payload,since,
+                                   page_size=payload.get('Limit'),msg='请求历史失败')
+        if not medias and since is None:
             log.warning('Emby无历史播放记录')
-        else:
-            for item in data.get('Items'):
-                if item.get('Type').lower() == 'movie':
-                    media = Movie(item,self._server)
-                elif item.get('Type').lower() == 'episode':
-                    media = Episode(item,self._server)
-                media.LastPlayedDate = datetime.fromisoformat(
-                    item['UserData'].get("LastPlayedDate")[:-2])
-                medias.append(media)
         return medias
 
     async def get_person(self):
         path = "/Persons"
-        payload = {
-            "Fields":"ProviderIds"
-        }
+        payload = Library.projection(["ProviderIds"])
         data = await self._server.query(self.bulidurl(path,payload))
         for person in data.get("Items"):
             yield Person(person,self._server)
@@ -183,35 +348,78 @@ class Library(Util):
         data = await self._server.query(url)
         return data
     
-    async def all(self):
-        data = await self.fetchitems(Recursive=True,ParentId=self.Id,
-                                     IncludeItemTypes="Movie,Series",
-                                     Fields="UserData,OriginalTitle,Etag,SortName,ForcedSortName,ProviderIds,RecursiveItemCount,RunTimeTicks,UserDataLastPlayedDate")
-        if data.get('Items') == None:
-            return []
+    #分页获取，边获取边返回原始数据
+    async def iter_items(self,page_size:int=None,**kwargs):
+        page_size = page_size or PAGE_SIZE
+        start = 0
+        while True:
+            data = await self.fetchitems(StartIndex=start,Limit=page_size,**kwargs)
+            items = data.get('Items') or []
+            for item in items:
+                yield item
+            start += len(items)
+            #没有TotalRecordCount时取到不满一页为止
+            total = data.get('TotalRecordCount')
+            if len(items) < page_size or (total is not None and start >= total):
+                break
+
+    def _tomedia(self,item):
         if self.CollectionType == None:
-            media = []
-            for item in data.get('Items'):
-                if item.get("Type") == "Movie":
-                    media.append(Movie(item,self._server))
-                elif item.get("Type") == "Series":
-                    media.append(Show(item,self._server))
-                else:
-                    log.warning(f"{self.Name} 发现{item.get('Name')} 非电影或剧集")
-            return media
+            if item.get("Type") == "Movie":
+                return Movie(item,self._server)
+            elif item.get("Type") == "Series":
+                return Show(item,self._server)
+            else:
+                log.warning(f"{self.Name} 发现{item.get('Name')} 非电影或剧集")
         elif self.CollectionType.lower() == 'movies':
-            movies = []
-            for item in data.get('Items'):
-                movies.append(Movie(item,self._server))
-            return movies
+            return Movie(item,self._server)
         elif self.CollectionType.lower() == 'tvshows':
-            shows = []
-            for item in data.get('Items'):
-                shows.append(Show(item,self._server))
-            return shows
+            return Show(item,self._server)
         else:
             raise MediaTypeError('只支持电影、剧集和混合内容库')
 
+    @staticmethod
+    def projection(fields=None) -> dict:
+        """
+            fields: 任务需要的字段，包含UserData时才返回用户数据；None为默认的全部字段
+        """
+        if fields is None:
+            fields = FIELDS
+        fields = list(fields)
+        return {'Fields':','.join(fields),
+                'EnableImages':False,
+                'EnableUserData':'UserData' in fields}
+
+    async def iter_all(self,fields=None,**kwargs):
+        if self.CollectionType not in (None,'movies','tvshows'):
+            raise MediaTypeError('只支持电影、剧集和混合内容库')
+        async for item in self.iter_items(Recursive=True,ParentId=self.Id,
+                                          IncludeItemTypes="Movie,Series",
+                                          **self.projection(fields),**kwargs):
+            media = self._tomedia(item)
+            if media:
+                yield media
+
+    async def all(self,fields=None):
+        media = []
+        async for item in self.iter_all(fields):
+            media.append(item)
+        return media
+
+    #分页获取库内所有季，混合内容库同样适用
+    async def iter_seasons(self,fields=None):
+        async for item in self.iter_items(Recursive=True,ParentId=self.Id,
+                                          IncludeItemTypes="Season",
+                                          **self.projection(fields)):
+            yield Season(item,self._server)
+
+    #分页获取库内所有集，混合内容库同样适用
+    async def iter_episodes(self,fields=None,**kwargs):
+        async for item in self.iter_items(Recursive=True,ParentId=self.Id,
+                                          IncludeItemTypes="Episode",
+                                          **self.projection(fields),**kwargs):
+            yield Episode(item,self._server)
+
     async def refresh(self):
         path = f"/items/{self.Id}/Refresh"
         payload = {
@@ -228,26 +436,28 @@ class MixContent(Library):
     def __init__(self, data, server) -> None:
         super().__init__(data, server)
     #获取混合内容的电影
-    async def get_movie(self):
-        data = await self.fetchitems(Recursive=True,ParentId=self.Id,
-                                     IncludeItemTypes="Movie",
-                                     Fields="UserData,OriginalTitle,Etag,SortName,ForcedSortName,ProviderIds,RecursiveItemCount,RunTimeTicks,UserDataLastPlayedDate")
-        if data.get('Items') == None:
-            return []
+    async def iter_movie(self,fields=None):
+        async for item in self.iter_items(Recursive=True,ParentId=self.Id,
+                                          IncludeItemTypes="Movie",
+                                          **self.projection(fields)):
+            yield Movie(item,self._server)
+
+    async def get_movie(self,fields=None):
         media = []
-        for item in data.get('Items'):
-            media.append(Movie(item,self._server))
+        async for item in self.iter_movie(fields):
+            media.append(item)
         return media
     #获取混合内容的剧集
-    async def get_series(self):
-        data = await self.fetchitems(Recursive=True,ParentId=self.Id,
-                                     IncludeItemTypes="Series",
-                                     Fields="UserData,OriginalTitle,Etag,SortName,ForcedSortName,ProviderIds,RecursiveItemCount,RunTimeTicks,UserDataLastPlayedDate")
-        if data.get('Items') == None:
-            return []
+    async def iter_series(self,fields=None):
+        async for item in self.iter_items(Recursive=True,ParentId=self.Id,
+                                          IncludeItemTypes="Series",
+                                          **self.projection(fields)):
+            yield Show(item,self._server)
+
+    async def get_series(self,fields=None):
         media = []
-        for item in data.get('Items'):
-            media.append(Show(item,self._server))
+        async for item in self.iter_series(fields):
+            media.append(item)
         return media
 
 class MovieLibrary(Library):
@@ -258,13 +468,10 @@ class SeriesLibrary(Library):
     def __init__(self, data, server) -> None:
         super().__init__(data, server)
 
-    async def get_all_seasons(self):
+    async def get_all_seasons(self,fields=None):
         seasons = []
-        data = await self.fetchitems(Recursive=True,ParentId=self.Id,
-                                     IncludeItemTypes="Season",
-                                     Fields="UserData,OriginalTitle,Etag,SortName,ForcedSortName,ProviderIds,RecursiveItemCount,RunTimeTicks,UserDataLastPlayedDate")
-        for season in data.get("Items"):
-            seasons.append(Season(season,self._server))
+        async for season in self.iter_seasons(fields):
+            seasons.append(season)
         return seasons
 
 class Media(Util):
@@ -295,7 +502,7 @@ class Media(Util):
         self.People = self.data.get('People')
         self.ProviderIds = self.data.get('ProviderIds')
         self.tmdb = self.tmdbid = self.imdb = self.imdbid = self.tvdb = self.tvdbid = None
-        for k,v in self.ProviderIds.items():
+        for k,v in (self.ProviderIds or {}).items():
             if 'tmdb' == k.lower():
                 self.tmdb = 'tmdb://' + v if v else None
                 self.tmdbid = v if v else None
@@ -308,7 +515,7 @@ class Media(Util):
         self.RecursiveItemCount = self.data.get('RecursiveItemCount')
         self.RunTimeTicks = self.data.get('RunTimeTicks')
         self.UserData = self.data.get('UserData')
-        if self.UserData.get("LastPlayedDate"):
+        if self.UserData and self.UserData.get("LastPlayedDate"):
             self.LastPlayedDate = datetime.fromisoformat(self.UserData.get("LastPlayedDate")[:-2])
     #刷新重载媒体数据
     async def fetchitem(self):
@@ -317,6 +524,9 @@ class Media(Util):
         self._loaddata()
     
     async def edit(self,data):
+        """
+            emby保存时会用提交的数据覆盖整个条目，data应为fetchitem取到的数据(已包含EDIT_FIELDS)
+        """
         payload = {"reqformat":"json"}
         path = f"/Items/{self.Id}"
         await self._server.query(self.bulidurl(path,payload),method='post',json=data)
@@ -349,25 +559,29 @@ class Show(Media):
         for se in data['Items']:
             ses.append(Season(se,self._server))
         return ses
-    #获取剧集集
-    async def episodes(self):
+    #获取剧集集，season为季数，不填为全部
+    async def episodes(self,season:int=None):
         path = f'/Shows/{self.Id}/Episodes'
         payload = {'UserId': self._server.userid}
+        if season is not None:
+            payload['Season'] = season
         url = self.bulidurl(path,payload)
         data = await self._server.query(url)
-        self.TotalRecordCount = data.get('TotalRecordCount')
+        if season is None:
+            self.TotalRecordCount = data.get('TotalRecordCount')
         eps = []
         for ep in data['Items']:
             eps.append(Episode(ep,self._server))
         return eps
-    #获取特定集
+    #获取特定集，只请求该季，同一个Show同一季多次查找只请求一次
     async def episode(self,season_num:int=None,episode_num:int=None):
         if season_num or episode_num:
-            eps = await self.episodes()
-            for ep in eps:
-                if ep.ParentIndexNumber == season_num and ep.IndexNumber == episode_num:
-                    return ep
-            return None
+            if not hasattr(self,'_episode_index'):
+                self._episode_index = {}
+            if season_num not in self._episode_index:
+                eps = await self.episodes(season_num)
+                self._episode_index[season_num] = index_by(eps,lambda ep: ep.episode_key())
+            return self._episode_index[season_num].get((season_num,episode_num))
         #else:
         raise InvalidParams('请传入合法参数')
 
@@ -384,7 +598,7 @@ class Season(Media):
         self.SeriesId = self.data.get('SeriesId')
         self.SeriesName = self.data.get('SeriesName')
         self.Type = self.data.get('Type')
-        self.UserData = self.data.get('UserData')
+        self.UserData = self.data.get('UserData') or {}
         self.Played = self.UserData.get('Played')
         self.UnplayedItemCount = self.UserData.get('UnplayedItemCount')
 
@@ -425,7 +639,7 @@ class Episode(Media):
         self.ParentIndexNumber = self.data.get('ParentIndexNumber')
         self.IndexNumber = self.data.get('IndexNumber')
         self.Type = self.data.get('Type')
-        self.UserData = self.data.get('UserData')
+        self.UserData = self.data.get('UserData') or {}
         self.PlaybackPositionTicks = self.UserData.get('PlaybackPositionTicks')
         self.Played = self.UserData.get('Played')
         self.SeriesName = self.data.get('SeriesName')
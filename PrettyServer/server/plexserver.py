@@ -1,4 +1,4 @@
-import aiohttp
+import asyncio
 import re
 import time
 from platform import uname
@@ -6,6 +6,27 @@ from uuid import getnode
 from util.util import Util
 from util.exception import AsyncError,InvalidParams,FailRequest,MediaTypeError
 from util.log import log
+from util.transport import transport
+from util.match import index_by
+from util.batch import BatchLoader
+from conf.conf import PAGE_SIZE
+
+#指定字段时，列表里不需要的子元素
+EXCLUDE_ELEMENTS = "Genre,Country,Director,Writer,Role,Producer,Collection,Label,Similar,Image,Media,Field"
+
+def guid_ids(guids) -> dict:
+    """
+        [{'id': 'tmdb://123'},...] -> {'tmdb': '123',...}
+    """
+    ids = {}
+    for guid in guids or []:
+        gid = guid.get('id','').lower()
+        for provider in ('tmdb','imdb','tvdb'):
+            if gid.startswith(provider):
+                num = re.findall(r'\d+',gid,re.S)
+                if num:
+                    ids[provider] = num[0]
+    return ids
 
 class Plexserver(Util):
 
@@ -26,47 +47,144 @@ class Plexserver(Util):
         self.url = plex_url.rstrip('/')
         self.type = 'plex'
         self._server = self
+        #多个条目的元数据合并成/library/metadata/a,b,c一次获取
+        self.metaloader = BatchLoader(f'plex_metadata({self.url})',self._fetchmany)
+
+    async def _fetchmany(self,ekeys:list):
+        """
+            批量获取元数据，按ratingKey拆成和单个获取相同的格式
+        """
+        try:
+            data = await self.query(f'/library/metadata/{",".join(ekeys)}',
+                                    msg='请求失败，请检查网络或ekey')
+        except FailRequest:
+            if len(ekeys) == 1:
+                raise
+            #某个条目有问题导致整批失败时，退回逐个获取
+            result = {}
+            for ekey in ekeys:
+                try:
+                    result.update(await self._fetchmany([ekey]))
+                except FailRequest as e:
+                    #只有不存在的条目才当作没有结果，其它错误交给调用者
+                    if e.status != 404:
+                        raise
+            return result
+        container = data['MediaContainer']
+        result = {}
+        for item in container.get('Metadata') or []:
+            single = {k:v for k,v in container.items() if k != 'Metadata'}
+            for k in ('librarySectionID','librarySectionTitle','librarySectionUUID'):
+                if item.get(k) is not None:
+                    single[k] = item.get(k)
+            single['size'] = 1
+            single['Metadata'] = [item]
+            result[str(item.get('ratingKey'))] = {'MediaContainer':single}
+        return result
+
+    async def get_item(self,ekey):
+        """
+            按ratingKey获取单个电影或单集，其它类型返回None
+        """
+        data = await self.metaloader.load(str(ekey))
+        if data is None:
+            raise FailRequest('请求失败，请检查网络或ekey',404)
+        item = data['MediaContainer']['Metadata'][0]
+        if item.get('type').lower() == 'movie':
+            return Movie(item,self._server)
+        elif item.get('type').lower() == 'episode':
+            return Episode(item,self._server)
+
+    async def get_medias(self,ekeys:list):
+        """
+            按ratingKey批量获取电影和剧集，其它类型和不存在的条目忽略
+        """
+        datas = await asyncio.gather(*[self.metaloader.load(str(ekey)) for ekey in ekeys])
+        medias = []
+        for data in datas:
+            if data is None:
+                continue
+            item = data['MediaContainer']['Metadata'][0]
+            if item.get('type').lower() == 'movie':
+                media = Movie(item,self._server)
+            elif item.get('type').lower() == 'show':
+                media = Show(item,self._server)
+            else:
+                continue
+            #没有调用fetchitem，编辑标题排序时需要
+            media.librarySectionID = data['MediaContainer'].get('librarySectionID') or item.get('librarySectionID')
+            medias.append(media)
+        return medias
 
     async def library(self):
-        if not hasattr(self,'session'):
-            self.session = aiohttp.ClientSession()
         data = await self.query('/library/sections/',msg='请求失败，请检查网络或Plex地址和Token')
         return Library(data,self._server)
 
-    async def hub_continue(self):
-        data = await self._server.query('/hubs/home/continueWatching')
+    async def _pages(self,path:str,payload:dict=None,page_size:int=None,msg:str=None):
+        """
+            分页获取原始条目
+        """
+        page_size = page_size or PAGE_SIZE
+        start = 0
+        while True:
+            page = dict(payload or {})
+            page.update({'X-Plex-Container-Start': start,
+                         'X-Plex-Container-Size': page_size})
+            data = await self._server.query(self.bulidurl(path,page),msg=msg)
+            items = data['MediaContainer'].get('Metadata') or []
+            for item in items:
+                yield item
+            start += len(items)
+            if len(items) < page_size:
+                break
+
+    def _tomedias(self,items) -> list:
         medias = []
-        if data['MediaContainer'].get('size') == 0:
-            log.warning(f'Plex({self.name})主界面没有继续观看')
-        else:
-            for item in data['MediaContainer'].get('Metadata'):
-                if item.get('type').lower() == 'movie':
-                    medias.append(Movie(item,self._server))
-                elif item.get('type').lower() == 'episode':
-                    medias.append(Episode(item,self._server))
+        for item in items or []:
+            if item.get('type').lower() == 'movie':
+                medias.append(Movie(item,self._server))
+            elif item.get('type').lower() == 'episode':
+                medias.append(Episode(item,self._server))
         return medias
 
-    async def history(self,**kwargs):
-        if kwargs:
-            payload = kwargs
+    async def hub_continue(self,since:int=None):
+        """
+            since：同步任务的继续观看时间戳，给出时分页获取，只返回之后的条目
+        """
+        if since is None:
+            data = await self._server.query('/hubs/home/continueWatching')
+            items = data['MediaContainer'].get('Metadata')
         else:
+            items = []
+            async for item in self._pages('/hubs/home/continueWatching'):
+                #按最后观看时间倒序，早于时间戳的不用再取
+                if (item.get('lastViewedAt') or 0) <= since:
+                    break
+                items.append(item)
+        medias = self._tomedias(items)
+        if not medias and since is None:
+            log.warning(f'Plex({self.name})主界面没有继续观看')
+        return medias
+
+    async def history(self,since:int=None,**kwargs):
+        """
+            since：同步任务的已观看时间戳，只分页获取之后的记录，默认最近7天
+        """
+        try:
+            if kwargs:
+                path = self.bulidurl('/status/sessions/history/all',kwargs)
+                data = await self._server.query(path,msg='请求历史失败')
+                return self._tomedias(data['MediaContainer'].get('Metadata'))
             payload = {
                 'sort':'viewedAt:desc',
-                'viewedAt>': int(time.time() - 604800),
+                'viewedAt>': int(since if since is not None else time.time() - 604800),
                 'accountID': 1
             }
-        path = self.bulidurl('/status/sessions/history/all',payload)
-        try:
-            data = await self._server.query(path,msg='请求历史失败')
-            medias = []
-            if data['MediaContainer'].get('size') == 0:
+            items = [item async for item in self._pages('/status/sessions/history/all',payload,
+                                                        msg='请求历史失败')]
+            medias = self._tomedias(items)
+            if not medias and since is None:
                 log.warning(f'Plex({self.name})无历史播放记录')
-            else:
-                for item in data['MediaContainer'].get('Metadata'):
-                    if item.get('type').lower() == 'movie':
-                        medias.append(Movie(item,self._server))
-                    elif item.get('type').lower() == 'episode':
-                        medias.append(Episode(item,self._server))
             return medias
         except FailRequest:
             medias = await self._history()
@@ -86,31 +204,57 @@ class Plexserver(Util):
         else:
             return sort_medias
         
-    async def guidsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
+    async def build_index(self):
+        """
+            全量重建刮削ID索引
+        """
         lb = await self.library()
+        items = []
+        for section in lb.sections():
+            if section.type not in ('movie','show'):
+                continue
+            async for item in section.iter_items(fields=('ratingKey','Guid'),includeGuids=1):
+                items.append((item.get('ratingKey'),section.type,guid_ids(item.get('Guid'))))
+        self.guidindex.rebuild(items)
+        log.info(f'Plex({self.name})：刮削ID索引重建完成，共{len(items)}个条目')
+
+    async def _indexsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
         medias = []
+        for ekey,type in self.guidindex.lookup(tmdb=tmdb,tvdb=tvdb,imdb=imdb):
+            if type == 'show':
+                media = Show({'ratingKey':ekey},self._server)
+            else:
+                media = Movie({'ratingKey':ekey},self._server)
+            try:
+                await media.fetchitem()
+            except FailRequest as e:
+                #只有404说明条目已被删除，超时，5xx等不动索引
+                if e.status != 404:
+                    raise
+                self.guidindex.remove(ekey)
+                continue
+            medias.append(media)
+        return medias
+
+    async def guidsearch(self,tmdb:str=None,tvdb:str=None,imdb:str=None):
+        medias = await self._indexsearch(tmdb=tmdb,tvdb=tvdb,imdb=imdb)
+        if medias:
+            return medias
+        lb = await self.library()
         for section in lb.sections():
-            if tmdb:
-                media = await section._guidsearch(f"tmdb://{tmdb}")
-                if media:
-                    medias.append(media)
-                    continue
-            if tvdb:
-                media = await section._guidsearch(f"tvdb://{tvdb}")
-                if media:
-                    medias.append(media)
+            for provider,pid in (('tmdb',tmdb),('tvdb',tvdb),('imdb',imdb)):
+                if not pid:
                     continue
-            if imdb:
-                media = await section._guidsearch(f"imdb://{imdb}")
+                media = await section._guidsearch(f"{provider}://{pid}")
                 if media:
                     medias.append(media)
-                    continue
+                    self.guidindex.add(media.ratingKey,section.type,**{provider:pid})
+                    break
                 
         return medias
     #close plex aio session
     async def close(self):
-        if hasattr(self,"session"):
-            await self.session.close()
+        await transport.close(self.url)
 
 class Library(Util):
     
@@ -137,17 +281,55 @@ class Section(Util):
         self.title = data['title']
         self.agent = data.get('agent')
 
+    #分页获取原始条目；fields为任务需要的字段，None为全部
+    async def iter_items(self,page_size:int=None,fields=None,**kwargs):
+        if self.type.lower() not in ('show','movie'):
+            return
+        page_size = page_size or PAGE_SIZE
+        start = 0
+        while True:
+            payload = dict(kwargs)
+            if fields is not None:
+                payload.update({'includeFields': ','.join(fields),
+                                'excludeElements': EXCLUDE_ELEMENTS})
+            payload.update({'X-Plex-Container-Start': start,
+                            'X-Plex-Container-Size': page_size})
+            path = self.bulidurl(f'/library/sections/{self.key}/all',payload)
+            data = await self._server.query(path)
+            container = data['MediaContainer']
+            #totalSize只有部分版本返回，没有时取到不满一页为止
+            self._totalsize = container.get('totalSize')
+            self._sectionid = container.get('librarySectionID',self.key)
+            items = container.get('Metadata') or []
+            for item in items:
+                yield item
+            start += len(items)
+            if len(items) < page_size or (self._totalsize is not None and start >= self._totalsize):
+                break
+
+    #分页获取，边获取边返回
+    async def iter_all(self,page_size:int=None,fields=None,**kwargs):
+        async for item in self.iter_items(page_size,fields,**kwargs):
+            if self.type.lower() == 'show':
+                media = Show(item,self._server)
+            elif self.type.lower() == 'movie':
+                media = Movie(item,self._server)
+            #列表里没有librarySectionID，编辑时需要
+            media.librarySectionID = self._sectionid
+            yield media
+
+    #分页获取剧集库内的集
+    async def iter_episodes(self,page_size:int=None,fields=None,**kwargs):
+        if self.type.lower() != 'show':
+            return
+        async for item in self.iter_items(page_size,fields,type=4,**kwargs):
+            yield Episode(item,self._server)
+
     #get all media for a specific setion
-    async def all(self):
+    async def all(self,fields=None):
         medias = []
-        data = await self._server.query(f'/library/sections/{self.key}/all')
-        self._totalsize = data['MediaContainer']['size']
-        if self._totalsize > 0:
-            for media in data['MediaContainer']['Metadata']:
-                if self.type.lower() == 'show':
-                    medias.append(Show(media,self._server))
-                elif self.type.lower() == 'movie':
-                    medias.append(Movie(media,self._server))
+        async for media in self.iter_all(fields=fields):
+            medias.append(media)
         return medias
     
     async def _guidsearch(self,guid):
@@ -227,7 +409,9 @@ class Media(Util):
 
     #Get more data for a specific media
     async def fetchitem(self):
-        data = await self._fetchitem(self.ratingKey)
+        data = await self._server.metaloader.load(str(self.ratingKey))
+        if data is None:
+            raise FailRequest('请求失败，请检查网络或ekey',404)
         if not self.title:
             self.data = data['MediaContainer']['Metadata'][0]
             self._loaddata()
@@ -258,6 +442,10 @@ class Media(Util):
         if self.type.lower() == 'show':
             self.Location = data['MediaContainer']['Metadata'][0].get('Location')
             self.childCount = data['MediaContainer']['Metadata'][0].get('childCount')
+        #顺便更新刮削ID索引
+        if self.type.lower() in ('movie','show') and hasattr(self._server,'guidindex'):
+            self._server.guidindex.add(self.ratingKey,self.type.lower(),
+                                       tmdb=self.tmdbid,imdb=self.imdbid,tvdb=self.tvdbid)
 
     #get all Role about the media
     def roles(self):
@@ -328,11 +516,10 @@ class Show(Media):
     #get specfic episode
     async def episode(self,season_num:int=None,episode_num:int=None):
         if season_num or episode_num:
-            eps = await self.episodes()
-            for ep in eps:
-                if ep.parentIndex == season_num and ep.index == episode_num:
-                    return ep
-            return None
+            #同一个Show多次查找只请求一次
+            if not hasattr(self,'_episode_index'):
+                self._episode_index = index_by(await self.episodes(),lambda ep: ep.episode_key())
+            return self._episode_index.get((season_num,episode_num))
         #else:
         raise InvalidParams('请传入合法参数')
 
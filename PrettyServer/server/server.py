@@ -3,13 +3,15 @@ from server.plexserver import Plexserver
 from server.embyserver import Embyserver
 from util.log import log
 from conf.conf import check_exist,SERVER_LIST
+from util.store import GuidIndex
+from server.websocket import EmbySocket,PlexSocket
 from task.roletask import PlexRoleTask,EmbyRoleTask
 from task.sorttask import SortTask
 from task.scantask import ScanTask
 from task.mergetask import MergeTask
 from task.titletask import TitleTask
 
-async def get_server(tmdb_session,sem):
+async def get_server(tmdb):
     servers = []
     try:
         for server in SERVER_LIST:
@@ -21,9 +23,13 @@ async def get_server(tmdb_session,sem):
                                 check_exist(server,"username","emby"),check_exist(server,"password","emby"))
                 if server.get("token") == None:
                     await s.login()
-            s.tmdb_session = tmdb_session
-            s.sem = sem
+            s.tmdb = tmdb
             s.name = check_exist(server,"name",'server')
+            s.guidindex = GuidIndex(s.name)
+            #可选：通过websocket接收服务器推送的事件
+            s.socket = None
+            if server.get("websocket"):
+                s.socket = PlexSocket(s) if isinstance(s,Plexserver) else EmbySocket(s)
             if isinstance(s,Plexserver):
                 s.roletask = PlexRoleTask(s,check_exist(server,"roletask",s.name))
             elif isinstance(s,Embyserver):
@@ -0,0 +1,169 @@
+import asyncio
+import traceback
+import aiohttp
+from abc import ABC,abstractmethod
+from util.log import log
+from util.events import bus
+from util.transport import transport
+from util.metrics import metrics
+
+class Socket(ABC):
+    """
+        服务器推送长连接基本类，断线自动重连，
+        条目变化发布到 {服务器名}.library_changed，观看数据变化发布到 {服务器名}.userdata_changed
+        plex媒体库扫描完成发布到 {服务器名}.scan_finished
+    """
+    #重连等待上限(秒)
+    RECONNECT_MAX = 60
+
+    def __init__(self,server) -> None:
+        self.server = server
+        self.connected = False
+        self.reconnects = 0
+        metrics.register(f'websocket.{server.name}',self.stats)
+
+    @abstractmethod
+    def _url(self) -> str:
+        """
+            websocket地址
+        """
+
+    async def _prepare(self):
+        pass
+
+    @abstractmethod
+    def _on_message(self,ws,message:dict):
+        """
+            处理一条推送消息
+        """
+
+    def _on_close(self):
+        pass
+
+    async def run(self):
+        label = self.server.type.capitalize()
+        delay = 1
+        while True:
+            try:
+                await self._prepare()
+                session = transport.session(self.server.url,stream=True)
+                async with session.ws_connect(self._url(),heartbeat=30) as ws:
+                    self.connected = True
+                    delay = 1
+                    log.info(f'{label}({self.server.name})：websocket已连接')
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._on_message(ws,msg.json())
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED,aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.debug(traceback.format_exc())
+            finally:
+                self.connected = False
+                self._on_close()
+            self.reconnects += 1
+            log.warning(f'{label}({self.server.name})：websocket断开，{delay}秒后重连')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2,self.RECONNECT_MAX)
+
+    def stats(self) -> dict:
+        return {'connected':self.connected,'reconnects':self.reconnects}
+
+class EmbySocket(Socket):
+    """
+        emby /embywebsocket：UserDataChanged，LibraryChanged
+    """
+    def __init__(self,server) -> None:
+        super().__init__(server)
+        self._keepalive_task = None
+
+    def _url(self):
+        base = self.server.url
+        if base.endswith('/emby'):
+            base = base[:-len('/emby')]
+        base = base.replace('https://','wss://',1).replace('http://','ws://',1)
+        return f'{base}/embywebsocket?api_key={self.server.token}&deviceId=PrettyServer'
+
+    async def _prepare(self):
+        if not hasattr(self.server,'userid'):
+            await self.server.login()
+
+    async def _keepalive(self,ws,interval:float):
+        while not ws.closed:
+            await ws.send_json({'MessageType':'KeepAlive'})
+            await asyncio.sleep(interval)
+
+    def _on_close(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+
+    def _on_message(self,ws,message:dict):
+        type = message.get('MessageType')
+        data = message.get('Data') or {}
+        if type == 'ForceKeepAlive':
+            if self._keepalive_task is None:
+                #服务器要求的超时时间(秒)，按一半的间隔发送KeepAlive
+                interval = max((message.get('Data') or 60) / 2,5)
+                self._keepalive_task = asyncio.ensure_future(self._keepalive(ws,interval))
+        elif type == 'UserDataChanged':
+            #只关心登录用户自己的观看数据
+            if data.get('UserId') != getattr(self.server,'userid',None):
+                return
+            ids = [u.get('ItemId') for u in data.get('UserDataList') or [] if u.get('ItemId')]
+            if ids:
+                bus.publish(f'{self.server.name}.userdata_changed',ids)
+        elif type == 'LibraryChanged':
+            for id in data.get('ItemsRemoved') or []:
+                self.server.guidindex.remove(id)
+            ids = list(dict.fromkeys((data.get('ItemsAdded') or []) + (data.get('ItemsUpdated') or [])))
+            if ids:
+                bus.publish(f'{self.server.name}.library_changed',ids)
+
+class PlexSocket(Socket):
+    """
+        plex /:/websockets/notifications：timeline，playing，activity
+    """
+    #timeline中的条目类型：1电影，2剧集
+    MEDIA_TYPES = (1,2)
+    #timeline状态：5元数据处理完成，9已删除
+    STATE_DONE = 5
+    STATE_DELETED = 9
+
+    def _url(self):
+        base = self.server.url.replace('https://','wss://',1).replace('http://','ws://',1)
+        return f'{base}/:/websockets/notifications?X-Plex-Token={self.server.header["X-Plex-Token"]}'
+
+    def _on_message(self,ws,message:dict):
+        container = message.get('NotificationContainer') or {}
+        type = container.get('type')
+        if type == 'timeline':
+            self._timeline(container.get('TimelineEntry') or [])
+        elif type == 'playing':
+            #停止播放时同步该条目的观看进度
+            ids = [str(n.get('ratingKey')) for n in container.get('PlaySessionStateNotification') or []
+                   if n.get('state') == 'stopped' and n.get('ratingKey')]
+            if ids:
+                bus.publish(f'{self.server.name}.userdata_changed',ids)
+        elif type == 'activity':
+            for n in container.get('ActivityNotification') or []:
+                activity = n.get('Activity') or {}
+                if n.get('event') == 'ended' and activity.get('type') == 'library.update.section':
+                    section = (activity.get('Context') or {}).get('librarySectionID')
+                    log.info(f'Plex({self.server.name})：{activity.get("title") or "媒体库扫描"}完成')
+                    bus.publish(f'{self.server.name}.scan_finished',section)
+
+    def _timeline(self,entries:list):
+        ids = []
+        for entry in entries:
+            if entry.get('identifier') != 'com.plexapp.plugins.library':
+                continue
+            item = entry.get('itemID')
+            if entry.get('state') == self.STATE_DELETED:
+                self.server.guidindex.remove(item)
+            elif entry.get('state') == self.STATE_DONE and entry.get('type') in self.MEDIA_TYPES:
+                ids.append(str(item))
+        if ids:
+            bus.publish(f'{self.server.name}.library_changed',list(dict.fromkeys(ids)))
@@ -1,12 +1,145 @@
+import asyncio
+import time
+import traceback
 from asyncio import Lock
-from conf.conf import check_exist
+from conf.conf import check_exist,PIPELINE
 from server.plexserver import Plexserver
 from server.embyserver import Embyserver
+from util.log import log
+
+_STOP = object()
+
+class Pipeline():
+    """
+        生产者/消费者流水线：有界队列 + 固定数量worker，
+        队列满时生产者等待(背压)，内存占用只和并发数有关，和媒体库大小无关
+    """
+    def __init__(self, name:str, worker, workers:int=None, queue_size:int=None) -> None:
+        self.name = name
+        self.worker = worker
+        self.workers = workers or PIPELINE.get('workers',20)
+        self.queue_size = queue_size or PIPELINE.get('queue_size',self.workers * 2)
+        #统计
+        self.produced = 0
+        self.done = 0
+        self.failed = 0
+        self.max_depth = 0
+        #生产者因为队列满而等待的时间
+        self.blocked = 0.0
+        #worker实际处理的时间
+        self.busy = 0.0
+
+    async def _consume(self, queue:asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            start = time.monotonic()
+            try:
+                await self.worker(item)
+                self.done += 1
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                raise
+            except:
+                self.failed += 1
+                log.error(f'{self.name}处理失败：{traceback.format_exc()}')
+            finally:
+                self.busy += time.monotonic() - start
+
+    async def run(self, producer):
+        """
+            producer: 异步迭代器或普通可迭代对象
+        """
+        start = time.monotonic()
+        queue = asyncio.Queue(self.queue_size)
+        consumers = [asyncio.create_task(self._consume(queue)) for _ in range(self.workers)]
+        try:
+            if hasattr(producer,'__aiter__'):
+                async for item in producer:
+                    await self._put(queue,item)
+            else:
+                for item in producer:
+                    await self._put(queue,item)
+            for _ in consumers:
+                await queue.put(_STOP)
+            await asyncio.gather(*consumers)
+        except BaseException:
+            for c in consumers:
+                c.cancel()
+            raise
+        log.info(f'{self.name}：{self.stats(time.monotonic() - start)}')
+
+    async def _put(self, queue:asyncio.Queue, item):
+        self.produced += 1
+        if queue.full():
+            start = time.monotonic()
+            await queue.put(item)
+            self.blocked += time.monotonic() - start
+        else:
+            queue.put_nowait(item)
+        self.max_depth = max(self.max_depth,queue.qsize())
+
+    def stats(self, elapsed:float=None) -> str:
+        msg = (f'生产{self.produced}个，完成{self.done}个，失败{self.failed}个，'
+               f'最大队列深度{self.max_depth}，生产者等待{self.blocked:.1f}秒，'
+               f'worker({self.workers})处理{self.busy:.1f}秒')
+        if elapsed is not None:
+            msg += f'，总耗时{elapsed:.1f}秒'
+        return msg
+
 class BaseTask():
+    #事件推送的条目攒多久(秒)再处理，媒体库扫描时会连续推送很多条目
+    EVENT_DELAY = 10
+    #处理过的条目在这段时间(秒)内再次推送时忽略，任务自己的修改也会触发推送
+    EVENT_ECHO = 120
+
     def __init__(self, mediaserver, task_info:dict) -> None:
         self.server = mediaserver
         self._info = task_info
         self.is_run = check_exist(self._info, "run", list(self._info.keys())[0])
+        #可选：单个任务的worker数
+        self.workers = self._info.get("workers")
+        self._pending_ids = set()
+        self._flush_task = None
+        #条目id -> 忽略推送的截止时间
+        self._handled = {}
+
+    def pipeline(self, name:str, worker) -> Pipeline:
+        return Pipeline(name,worker,self.workers)
+
+    def on_items(self, ids:list):
+        """
+            事件订阅入口：收集变化的条目id，攒一段时间后交给run_items
+        """
+        now = time.monotonic()
+        self._handled = {id:t for id,t in self._handled.items() if t > now}
+        self._pending_ids.update(str(id) for id in ids if str(id) not in self._handled)
+        if not self._pending_ids:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_items())
+
+    async def _flush_items(self):
+        #处理期间推送的条目留在_pending_ids里，处理完再攒一轮，直到没有新条目
+        while self._pending_ids:
+            await asyncio.sleep(self.EVENT_DELAY)
+            ids = list(self._pending_ids)
+            self._pending_ids = set()
+            expire = time.monotonic() + self.EVENT_ECHO
+            for id in ids:
+                self._handled[id] = expire
+            try:
+                await self.run_items(ids)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                return
+            except:
+                log.error(f'{self.server.name}：处理推送条目失败：{traceback.format_exc()}')
+
+    async def run_items(self, ids:list):
+        """
+            只处理指定条目，由支持事件驱动的任务实现，默认不处理
+        """
+        log.debug(f'{self.server.name}：{type(self).__name__}不支持按条目处理，忽略{len(ids)}个条目')
 
 class SyncTask():
     """
@@ -18,6 +151,7 @@ class SyncTask():
         self.is_run = check_exist(self._info, "run", 'Synctask')
         self._loadinfo()
         self.lock = Lock()
+        self.workers = self._info.get("workers")
         for server in servers:
             if server.name in self.which:
                 if isinstance(server,Plexserver):
@@ -28,6 +162,11 @@ class SyncTask():
     def _loadinfo(self):
         self.first = check_exist(self._info, "isfirst", self.name)
         self.which = check_exist(self._info, "which", self.name)
+        #可选：全量同步时批量拉取两边观看状态在本地比对
+        self.bulk = self._info.get("bulk", False)
+
+    def pipeline(self, name:str, worker) -> Pipeline:
+        return Pipeline(name,worker,self.workers)
 
 class MergeTask(BaseTask):
     """
@@ -61,6 +200,10 @@ class SortTask(BaseTask):
 
     def _loadinfo(self):
         self.crontab = check_exist(self._info, "crontab", list(self._info.keys())[0])
+        #可选：只处理上次运行后新增或修改的条目
+        self.incremental = self._info.get("incremental", False)
+        #可选：增量模式下，定期全量运行一次的crontab
+        self.full_crontab = self._info.get("full_crontab")
 
 class TitleTask(BaseTask):
     """
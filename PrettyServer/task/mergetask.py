@@ -2,35 +2,39 @@ import asyncio
 import traceback
 from server.embyserver import Embyserver
 from server.embyserver import MixContent
+import server.embyserver as embyserver
 from task.base import MergeTask as MT
 from util.log import log
 from util.exception import ServerTypeError
 
 class MergeTask(MT):
+    #合并只需要Id，Name，ProviderIds
+    FIELDS = ('ProviderIds',)
+
     def __init__(self, mediaserver, task_info: dict) -> None:
         super().__init__(mediaserver,task_info)
         if not isinstance(self.server,Embyserver):
             raise ServerTypeError("合并任务只支持emby")
+        self._merged = set()
 
     async def _merge(self,ids,name):
-        async with self.server.sem:
-            try:
-                log.info(f'{name}: 开始合并')
-                await self.server.merge_version(ids)
-                log.info(f'{name}: 合并完成，合并IDs:{ids}')
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                pass
-            except:
-                log.info(f'{name}合并失败: {traceback.format_exc()}')
+        try:
+            log.info(f'{name}: 开始合并')
+            await self.server.merge_version(ids)
+            log.info(f'{name}: 合并完成，合并IDs:{ids}')
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.info(f'{name}合并失败: {traceback.format_exc()}')
 
     async def _emby_movie_merge(self,lb):
         try:
             mediaid = []
             #若为混合内容，则只获取电影类型媒体
             if isinstance(lb,MixContent):
-                medias = await lb.get_movie()
+                medias = await lb.get_movie(self.FIELDS)
             else:
-                medias = await lb.all()
+                medias = await lb.all(self.FIELDS)
             index = 0
             for media in medias:
                 #判断是否有刮削
@@ -69,6 +73,27 @@ class MergeTask(MT):
         except:
             log.critical(f'{lb.Name}合并失败： {traceback.format_exc()}')
 
+    async def run_items(self,ids:list):
+        """
+            只为推送过来的电影查找重复版本
+        """
+        medias = [m for m in await self.server.get_medias(ids) if isinstance(m,embyserver.Movie)]
+        merged = set()
+        for media in medias:
+            if media.Id in merged:
+                continue
+            if not media.tmdbid:
+                log.warning(f'{media.Name}：没有tmdbid信息')
+                continue
+            same = [m for m in await self.server.guidsearch(tmdb=media.tmdbid)
+                    if isinstance(m,embyserver.Movie)]
+            ids = list(dict.fromkeys([media.Id] + [m.Id for m in same]))
+            #合并本身也会推送条目变化，合并过的组合不再重复合并
+            if len(ids) > 1 and frozenset(ids) not in self._merged:
+                merged.update(ids)
+                self._merged.add(frozenset(ids))
+                await self._merge(ids,media.Name)
+
     async def run(self):
         tasks = set()
         log.info(f"Emby({self.server.name})：开始合并版本任务，初始化中...")
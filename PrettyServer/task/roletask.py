@@ -1,7 +1,9 @@
 import asyncio
 import traceback
+from functools import partial
 from task.base import RoleTask
 from util.log import log
+from util.ratelimit import PRIORITY_BULK,PRIORITY_SYNC
 
 class EmbyRoleTask(RoleTask):
     def __init__(self, mediaserver, task_info: dict) -> None:
@@ -34,12 +36,8 @@ class EmbyRoleTask(RoleTask):
     async def run(self):
         log.info(f"Emby({self.server.name})：开始进行演员中文化...")
         try:
-            tasks = set()
-            async for p in self.server.get_person():
-                future = asyncio.create_task(self._emby_role(p))
-                future.add_done_callback(tasks.discard)
-                tasks.add(future)
-            await asyncio.gather(*tasks,return_exceptions=True)
+            pipeline = self.pipeline(f"Emby({self.server.name})演员中文化",self._emby_role)
+            await pipeline.run(self.server.get_person())
             log.info(f"Emby({self.server.name})：演员中文化执行完毕")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
@@ -47,70 +45,82 @@ class EmbyRoleTask(RoleTask):
             log.critical(traceback.format_exc())
 
 class PlexRoleTask(RoleTask):
+    #列表只需要定位条目，演员等信息由fetchitem获取
+    FIELDS = ('ratingKey','key','type','title')
+
     def __init__(self, mediaserver, task_info: dict) -> None:
         super().__init__(mediaserver, task_info)
 
-    async def _plexrole(self,media):
-        async with self.server.sem:
-            try:
-                await media.fetchitem()
-                if not media.tmdbid:
-                    log.warning(media.title+': 未找到该条目tmdb ID')
-                    return
-                if media.type == 'show':
-                    type = "tv"
-                elif media.type == 'movie':
-                    type = 'movie'
-                else:
-                    log.warning('Plex只支持电影和剧集')
-                    return
-                tmdb_data = await media.get_role_from_id(type,media.tmdbid)
-                cast_dir = {}
-                for cast in tmdb_data['cast']:
-                    if cast['known_for_department'] == 'Acting':
-                        cast_dir[f'{cast["name"]}'] = cast['id']
-                roles = media.roles()
-                actor = []
-                for role in roles:
-                    if not role.check_chs(role.tag):
-                        if cast_dir.get(role.tag,None):
-                            cid = cast_dir.get(role.tag)
-                            chsdir = await role.get_chs_name(cid)
-                            if chsdir['chs']:
-                                chsname = chsdir['chs']
-                                log.info(f'{media.title}: {role.tag} ------> {chsname}')
-                                role.tag = chsname
-                                actor.append(role)
-                            else:
-                                log.info(f'{media.title}: {role.tag} 暂无中文数据')
-                                actor.append(role)
+    async def _plexrole(self,media,priority:int=PRIORITY_BULK):
+        try:
+            await media.fetchitem()
+            if not media.tmdbid:
+                log.warning(media.title+': 未找到该条目tmdb ID')
+                return
+            if media.type == 'show':
+                type = "tv"
+            elif media.type == 'movie':
+                type = 'movie'
+            else:
+                log.warning('Plex只支持电影和剧集')
+                return
+            tmdb_data = await media.get_role_from_id(type,media.tmdbid,priority)
+            cast_dir = {}
+            for cast in tmdb_data['cast']:
+                if cast['known_for_department'] == 'Acting':
+                    cast_dir[f'{cast["name"]}'] = cast['id']
+            roles = media.roles()
+            actor = []
+            for role in roles:
+                if not role.check_chs(role.tag):
+                    if cast_dir.get(role.tag,None):
+                        cid = cast_dir.get(role.tag)
+                        chsdir = await role.get_chs_name(cid,priority)
+                        if chsdir['chs']:
+                            chsname = chsdir['chs']
+                            log.info(f'{media.title}: {role.tag} ------> {chsname}')
+                            role.tag = chsname
+                            actor.append(role)
                         else:
-                            log.warning(f'{media.title}: {role.tag} 未发现该演员在该影视tmdb条目中')
+                            log.info(f'{media.title}: {role.tag} 暂无中文数据')
                             actor.append(role)
                     else:
-                        log.info(f'{media.title}: {role.tag} 此演员已有中文数据')
+                        log.warning(f'{media.title}: {role.tag} 未发现该演员在该影视tmdb条目中')
                         actor.append(role)
-                await media.edit_role(actor)
-                log.info(media.title+': 修改完毕')
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                pass
-            except:
-                log.error(f'{media.title}修改演员失败：{traceback.format_exc()}')
+                else:
+                    log.info(f'{media.title}: {role.tag} 此演员已有中文数据')
+                    actor.append(role)
+            await media.edit_role(actor)
+            log.info(media.title+': 修改完毕')
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.error(f'{media.title}修改演员失败：{traceback.format_exc()}')
+
+    async def _medias(self):
+        library = await self.server.library()
+        sections = library.sections()
+        for section in sections:
+            async for media in section.iter_all(fields=self.FIELDS):
+                yield media
+
+    async def run_items(self,ids:list):
+        """
+            只处理推送过来的电影和剧集
+        """
+        medias = await self.server.get_medias(ids)
+        if medias:
+            log.info(f"Plex({self.server.name})：{len(medias)}个条目有变化，开始演员中文化")
+            #推送触发的tmdb请求排在全量任务前面
+            pipeline = self.pipeline(f"Plex({self.server.name})演员中文化",
+                                     partial(self._plexrole,priority=PRIORITY_SYNC))
+            await pipeline.run(medias)
 
     async def run(self):
         log.info(f"Plex({self.server.name})：开始进行演员中文化...")
         try:
-            tasks = set()
-            library = await self.server.library()
-            sections = library.sections()
-            for section in sections:
-                data = await section.all()
-                for media in data:
-                    future = asyncio.create_task(self._plexrole(media=media))
-                    future.add_done_callback(tasks.discard)
-                    tasks.add(future)
-
-            await asyncio.gather(*tasks,return_exceptions=True)
+            pipeline = self.pipeline(f"Plex({self.server.name})演员中文化",self._plexrole)
+            await pipeline.run(self._medias())
             log.info(f"Plex({self.server.name})：演员中文化执行完毕")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
@@ -1,94 +1,182 @@
 import asyncio
+import time
 import traceback
+from functools import partial
+from datetime import datetime,timezone
 from server.plexserver import Plexserver
 from server.embyserver import Embyserver
+import server.embyserver as embyserver
 from task.base import SortTask as ST
 from util.log import log
+from util.store import KeyValue
 from pypinyin import pinyin, Style,load_phrases_dict
 #更新词典
 load_phrases_dict({'九重天': [['j'], ['c'],['t']]})
 load_phrases_dict({'神藏': [['s'], ['z']]})
 
 class SortTask(ST):
+    #列表只请求排序需要的字段
+    PLEX_FIELDS = ('ratingKey','key','type','title','titleSort')
+    EMBY_FIELDS = ('SortName','OriginalTitle')
+    #增量查询往前多查一段时间，避免服务器时间误差漏掉条目
+    OVERLAP = 300
+
     def __init__(self, mediaserver, task_info: dict) -> None:
         super().__init__(mediaserver, task_info)
+        self.state = KeyValue()
+        #媒体库扫描完成后触发的运行
+        self._scan_tasks = set()
 
-    async def _plexsort(self,media):
-        async with self.server.sem:
-            try:
-                await media.fetchitem()
-                if media.titleSort is None:
-                    convert = pinyin(media.formatchs(media.title).strip("-"),style=Style(4))
-                    titlevalue = str.join('',list(map(lambda x:x[0],convert)))
-                    await media.edit_titlesort(titlevalue,lock=1)
-                    log.info(f'{media.title}: 改变标题排序为 {titlevalue}')
-                else:
-                    convert = pinyin(media.formatchs(media.title).strip("-"),style=Style(4))
-                    titlevalue = str.join('',list(map(lambda x:x[0],convert)))
-                    if titlevalue == media.titleSort:
-                        log.info(f'{media.title}: 已经存在标题排序{titlevalue}')
-                    else:
-                        await media.edit_titlesort(titlevalue,lock=1)
-                        log.info(f'{media.title}: 改变标题排序为 {titlevalue}')
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                pass
-            except:
-                log.error(f'{media.title}修改标题失败：{traceback.format_exc()}')
+    def _key(self,lb):
+        if isinstance(self.server,Plexserver):
+            return f'{self.server.name}:{lb.key}'
+        return f'{self.server.name}:{lb.Id}'
+
+    async def _changed(self,lb,since,fields):
+        """
+            只获取since之后新增或修改的条目
+        """
+        if isinstance(self.server,Plexserver):
+            seen = set()
+            for f in ('addedAt>','updatedAt>'):
+                async for media in lb.iter_all(fields=fields,**{f:int(since)}):
+                    if media.ratingKey in seen:
+                        continue
+                    seen.add(media.ratingKey)
+                    yield media
+        elif isinstance(self.server,Embyserver):
+            date = datetime.fromtimestamp(since,tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            async for media in lb.iter_all(fields,MinDateLastSaved=date):
+                yield media
 
-    async def _embysort(self,media):
-        async with self.server.sem:
-            try:
-                convert = pinyin(media.formatchs(media.Name).strip("-"),style=Style(4),heteronym=False)
+    async def _plexsort(self,media,errors:list=None):
+        try:
+            if media.titleSort is None:
+                convert = pinyin(media.formatchs(media.title).strip("-"),style=Style(4))
+                titlevalue = str.join('',list(map(lambda x:x[0],convert)))
+                await media.edit_titlesort(titlevalue,lock=1)
+                log.info(f'{media.title}: 改变标题排序为 {titlevalue}')
+            else:
+                convert = pinyin(media.formatchs(media.title).strip("-"),style=Style(4))
                 titlevalue = str.join('',list(map(lambda x:x[0],convert)))
-                split_title = titlevalue.split('-')
-                final = ''
-                for t in split_title:
-                    if t != '':
-                        final += ","+t
-                final = final.strip(",")
-                #在标题搜索的最后加入整个name的拼音
-                if len(split_title) != 1:
-                    final += ","+"".join(split_title)
-                if media.SortName != (titlevalue[0] if titlevalue[0].isdigit() else titlevalue) or \
-                media.OriginalTitle != final:
-                    await media.fetchitem()
-                    media.data["OriginalTitle"] = final
-                    media.data["ForcedSortName"] = titlevalue[0] if titlevalue[0].isdigit() else titlevalue
-                    media.data["SortName"] = titlevalue[0] if titlevalue[0].isdigit() else titlevalue
-                    media.data["LockedFields"].append("OriginalTitle") if  media.data["LockedFields"].count("OriginalTitle") == 0 else None
-                    media.data["LockedFields"].append("SortName") if  media.data["LockedFields"].count("SortName") == 0 else None
-                    log.info(f'{media.Name}: 改变标题排序为 {titlevalue}')
-                    await media.edit(media.data)
+                if titlevalue == media.titleSort:
+                    log.info(f'{media.title}: 已经存在标题排序{titlevalue}')
                 else:
-                    log.info(f'{media.Name}: 已经存在标题排序{titlevalue}')  
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                pass
-            except:
-                log.critical(f'{media.Name}标题排序失败：{traceback.format_exc()}')   
+                    await media.edit_titlesort(titlevalue,lock=1)
+                    log.info(f'{media.title}: 改变标题排序为 {titlevalue}')
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            if errors is not None:
+                errors.append(media)
+            log.error(f'{media.title}修改标题失败：{traceback.format_exc()}')
 
-    async def run(self):
-        log.info(f"{self.server.type.capitalize()}({self.server.name})：开始进行标题排序，拼音搜索...")
+    async def _embysort(self,media,errors:list=None):
         try:
-            tasks = set()
-            if isinstance(self.server,Plexserver):
-                library = await self.server.library()
-                sections = library.sections()
-            elif isinstance(self.server,Embyserver):
-                sections = await self.server.library()
-            for lb in sections:
-                if isinstance(self.server,Embyserver):
-                    if lb.CollectionType not in (None,"movies","tvshows"):
-                        log.warning(f'{lb.Name}：只支持电影、剧集和混合内容库，跳过此库')
-                        continue
-                data = await lb.all()
-                for media in data:
-                    if isinstance(self.server,Embyserver):
-                        future = asyncio.create_task(self._embysort(media=media))
-                    elif isinstance(self.server,Plexserver):
-                        future = asyncio.create_task(self._plexsort(media=media))
-                    future.add_done_callback(tasks.discard)
-                    tasks.add(future)
-            await asyncio.gather(*tasks,return_exceptions=True)
+            convert = pinyin(media.formatchs(media.Name).strip("-"),style=Style(4),heteronym=False)
+            titlevalue = str.join('',list(map(lambda x:x[0],convert)))
+            split_title = titlevalue.split('-')
+            final = ''
+            for t in split_title:
+                if t != '':
+                    final += ","+t
+            final = final.strip(",")
+            #在标题搜索的最后加入整个name的拼音
+            if len(split_title) != 1:
+                final += ","+"".join(split_title)
+            if media.SortName != (titlevalue[0] if titlevalue[0].isdigit() else titlevalue) or \
+            media.OriginalTitle != final:
+                await media.fetchitem()
+                media.data["OriginalTitle"] = final
+                media.data["ForcedSortName"] = titlevalue[0] if titlevalue[0].isdigit() else titlevalue
+                media.data["SortName"] = titlevalue[0] if titlevalue[0].isdigit() else titlevalue
+                media.data["LockedFields"].append("OriginalTitle") if  media.data["LockedFields"].count("OriginalTitle") == 0 else None
+                media.data["LockedFields"].append("SortName") if  media.data["LockedFields"].count("SortName") == 0 else None
+                log.info(f'{media.Name}: 改变标题排序为 {titlevalue}')
+                await media.edit(media.data)
+            else:
+                log.info(f'{media.Name}: 已经存在标题排序{titlevalue}')  
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            if errors is not None:
+                errors.append(media)
+            log.critical(f'{media.Name}标题排序失败：{traceback.format_exc()}')   
+
+    async def _medias(self,full,marks,section=None):
+        if isinstance(self.server,Plexserver):
+            library = await self.server.library()
+            sections = library.sections()
+        elif isinstance(self.server,Embyserver):
+            sections = await self.server.library()
+        for lb in sections:
+            if section is not None and self._key(lb) != f'{self.server.name}:{section}':
+                continue
+            if isinstance(self.server,Embyserver):
+                if lb.CollectionType not in (None,"movies","tvshows"):
+                    log.warning(f'{lb.Name}：只支持电影、剧集和混合内容库，跳过此库')
+                    continue
+            if isinstance(self.server,Embyserver):
+                fields = self.EMBY_FIELDS
+            else:
+                fields = self.PLEX_FIELDS
+            key = self._key(lb)
+            since = self.state.get('sorttask',key)
+            marks[key] = time.time()
+            if full or since is None:
+                medias = lb.iter_all(fields=fields)
+            else:
+                medias = self._changed(lb,since - self.OVERLAP,fields)
+            async for media in medias:
+                yield media
+
+    async def run_items(self,ids:list):
+        """
+            只处理推送过来的条目
+        """
+        if isinstance(self.server,Embyserver):
+            medias = [m for m in await self.server.get_medias(ids)
+                      if isinstance(m,(embyserver.Movie,embyserver.Show))]
+            worker = self._embysort
+        elif isinstance(self.server,Plexserver):
+            medias = await self.server.get_medias(ids)
+            worker = self._plexsort
+        if medias:
+            log.info(f"{self.server.type.capitalize()}({self.server.name})：{len(medias)}个条目有变化，开始标题排序")
+            pipeline = self.pipeline(f"{self.server.type.capitalize()}({self.server.name})标题排序",worker)
+            await pipeline.run(medias)
+
+    def on_scan_finished(self,section):
+        """
+            事件订阅入口：媒体库扫描完成后增量处理该库，补上推送漏掉的条目
+        """
+        future = asyncio.ensure_future(self.run(section=section))
+        future.add_done_callback(self._scan_tasks.discard)
+        self._scan_tasks.add(future)
+
+    async def run(self,full:bool=False,section=None):
+        """
+            full: 增量模式下强制全量运行，section: 只处理该库(plex的key，emby的Id)
+        """
+        full = full or (not self.incremental and section is None)
+        mode = '全量' if full else '增量'
+        log.info(f"{self.server.type.capitalize()}({self.server.name})：开始进行标题排序，拼音搜索({mode})...")
+        try:
+            marks = {}
+            #本次运行出错的条目，有出错时不推进增量时间戳，下次重新处理；每次运行单独计数，运行可能重叠
+            errors = []
+            if isinstance(self.server,Embyserver):
+                worker = partial(self._embysort,errors=errors)
+            elif isinstance(self.server,Plexserver):
+                worker = partial(self._plexsort,errors=errors)
+            pipeline = self.pipeline(f"{self.server.type.capitalize()}({self.server.name})标题排序",worker)
+            await pipeline.run(self._medias(full,marks,section))
+            #记录本次运行开始时间，下次增量从这里开始；有条目失败时保留原时间戳，下次重试
+            if errors:
+                log.warning(f"{self.server.type.capitalize()}({self.server.name})：{len(errors)}个条目标题排序失败，下次重新处理")
+            else:
+                for key,mark in marks.items():
+                    self.state.set('sorttask',key,mark)
             log.info(f"{self.server.type.capitalize()}({self.server.name})：标题排序，拼音搜索任务执行完毕")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
@@ -5,149 +5,414 @@ import datetime
 import server.embyserver as embyserver
 from server.plexserver import Movie,Episode
 from server.plexserver import Show
+from server.plexserver import guid_ids
 from task.base import SyncTask as ST
 from util.log import log
+from util.match import match
+from util.store import KeyValue,SyncJournal
+from util.writequeue import WriteQueue
+from conf.conf import GUID_INDEX
 
 class SyncTask(ST):
+    #全量同步时plex列表需要的字段，刮削ID由fetchitem获取
+    PLEX_FIELDS = ('ratingKey','key','type','title','duration','viewCount','viewOffset',
+                   'lastViewedAt','viewedLeafCount','leafCount')
+
+    #批量比对时plex剧集，集，电影列表需要的字段
+    PLEX_SHOW_FIELDS = ('ratingKey','type','title','Guid')
+    PLEX_EPISODE_FIELDS = ('ratingKey','key','type','title','grandparentRatingKey','grandparentTitle',
+                           'parentIndex','index','duration','viewCount','viewOffset','lastViewedAt')
+    PLEX_MOVIE_FIELDS = ('ratingKey','key','type','title','duration','viewCount','viewOffset',
+                         'lastViewedAt','Guid')
+    #批量比对时emby列表需要的字段
+    EMBY_FIELDS = ('ProviderIds','UserData')
+    PROVIDERS = ('tmdb','tvdb','imdb')
+
+    #webhook：同一条目在这段时间(秒)内的多个事件只处理最后一个
+    EVENT_DELAY = 2
+    #本任务修改过的条目在这段时间(秒)内产生的webhook视为回声，不再同步回去
+    ECHO_SECONDS = 30
+    #已应用事件的记录保留天数
+    JOURNAL_DAYS = 30
+    #持久化的同步时间戳
+    MARKS = ('last_viewing','last_viewed','last_viewingdate','last_vieweddate')
+    #(来源服务器,事件) -> 对应的时间戳
+    SOURCE_MARKS = {('plex','progress'):'last_viewing',('plex','watched'):'last_viewed',
+                    ('emby','progress'):'last_viewingdate',('emby','watched'):'last_vieweddate'}
+
     def __init__(self, task_info: dict, servers) -> None:
         super().__init__(task_info, servers)
+        #(服务器名,条目) -> 最新事件
+        self._events = {}
+        #(服务器名,条目) -> 回声过期时间
+        self._written = {}
+        self._event_tasks = set()
+        self.state = KeyValue()
+        self.journal = SyncJournal()
+        #同步进度期间的写缓冲
+        self.writes = WriteQueue(self.name)
+        self.buffering = False
+        #本轮同步失败的事件(时间戳名称,时间)
+        self._failed = []
+        #本轮进入写缓冲的事件
+        self._queued = set()
 
-    async def _synctask(self,media):
-        async with self.plex.sem:
+    async def build_index(self,force:bool=False):
+        """
+            重建plex，emby的刮削ID索引，force为False时只在索引过期时重建
+        """
+        rebuild = GUID_INDEX.get('rebuild_hours',24) * 3600
+        for server in (self.plex,self.emby):
             try:
-                await media.fetchitem()
-                if not media.guid:
-                    log.warning(media.title+': 未找到该条目任何刮削ID，请检查刮削')
+                age = server.guidindex.age()
+                if force or age is None or age > rebuild:
+                    await server.build_index()
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                pass
+            except:
+                log.error(f'{server.name}重建刮削ID索引失败：{traceback.format_exc()}')
+
+    @staticmethod
+    def _diff(plex_item,emby_item):
+        """
+            比较两边的观看状态，返回需要的修改(目标条目,动作,进度)，不需要修改返回None
+            规则：有已观看则优先已观看，否则以进度多的一方为准
+        """
+        plex_count = plex_item.viewCount
+        plex_offset = int(plex_item.viewOffset or 0)
+        emby_played = getattr(emby_item,'Played',None)
+        emby_ticks = getattr(emby_item,'PlaybackPositionTicks',None) or 0
+        if plex_count and emby_played:
+            return None
+        elif plex_count and not emby_played:
+            return (emby_item,'watched',None)
+        elif plex_offset or emby_ticks:
+            if plex_offset*10000 > emby_ticks:
+                return (emby_item,'timeline',plex_item.convertTime(plex_offset))
+            elif plex_offset*10000 < emby_ticks:
+                return (plex_item,'timeline',emby_item.convertTime(emby_ticks))
+        elif not plex_count and emby_played:
+            return (plex_item,'watched',None)
+        return None
+
+    async def _write(self,change,label:str):
+        target,action,value = change
+        if target._server is self.plex:
+            name,item = 'Plex',target.ratingKey
+        else:
+            name,item = 'Emby',target.Id
+        if action == 'watched':
+            await target.watched()
+            log.info(f'{label}：{name}已观看')
+        else:
+            await target.timeline(value)
+            log.info(f'{label}：{name}已同步进度')
+        self._mark(target._server,item)
+
+    async def _sync_episode(self,media,plex_ep,emby_ep):
+        change = self._diff(plex_ep,emby_ep)
+        if change:
+            await self._write(change,f'{media.title}.{plex_ep.pretty_ep_out()}')
+
+    async def _synctask(self,media):
+        try:
+            await media.fetchitem()
+            if not media.guid:
+                log.warning(media.title+': 未找到该条目任何刮削ID，请检查刮削')
+                return
+            else:
+                emby_medias = await self.emby.guidsearch(tmdb=media.tmdbid,imdb=media.imdbid,tvdb=media.tvdbid)
+                if not emby_medias:
+                    log.info(f'Emby服务器未找到：{media.title}')
                     return
-                else:
-                    emby_medias = await self.emby.guidsearch(tmdb=media.tmdbid,imdb=media.imdbid,tvdb=media.tvdbid)
-                    if not emby_medias:
-                        log.info(f'Emby服务器未找到：{media.title}')
-                        return
-                for emby_media in emby_medias:
-                    #电影同步
-                    if isinstance(media,Movie) and isinstance(emby_media,embyserver.Movie):
-                        #判断plex中该影视是否看过
-                        if media.viewOffset or media.viewCount:
-                            #同步操作
-                            if media.viewCount and emby_media.Played:
-                                pass
-                            elif media.viewCount and not emby_media.Played:
-                                await emby_media.watched()
-                                log.info(f'Emby服务器已观看：{media.title}')
-                            elif media.viewOffset or emby_media.PlaybackPositionTicks != 0:
-                                if int(media.viewOffset)*10000 - \
-                                emby_media.PlaybackPositionTicks > 0:
-                                    await emby_media.timeline(
-                                        media.convertTime(media.viewOffset))
-                                    log.info(f'Emby服务器已同步进度：{media.title}')
-                                elif int(media.viewOffset)*10000 - \
-                                    emby_media.PlaybackPositionTicks < 0:
-                                    await media.timeline(emby_media.convertTime(
-                                        emby_media.PlaybackPositionTicks))
-                                    log.info(f'Plex服务器已同步进度：{media.title}')
-                            elif not media.viewCount and emby_media.Played:
-                                await media.watched()
-                                log.info(f'Plex服务器已观看：{media.title}')
-                            else:
-                                log.warning(f'someting wrong:{media.title}')
-                        else:
-                            #若判断plex未看过，接下来判断emby是否看过
-                            if emby_media.PlaybackPositionTicks != 0:
+            for emby_media in emby_medias:
+                #电影同步
+                if isinstance(media,Movie) and isinstance(emby_media,embyserver.Movie):
+                    #判断plex中该影视是否看过
+                    if media.viewOffset or media.viewCount:
+                        #同步操作
+                        if media.viewCount and emby_media.Played:
+                            pass
+                        elif media.viewCount and not emby_media.Played:
+                            await emby_media.watched()
+                            log.info(f'Emby服务器已观看：{media.title}')
+                        elif media.viewOffset or emby_media.PlaybackPositionTicks != 0:
+                            if int(media.viewOffset)*10000 - \
+                            emby_media.PlaybackPositionTicks > 0:
+                                await emby_media.timeline(
+                                    media.convertTime(media.viewOffset))
+                                log.info(f'Emby服务器已同步进度：{media.title}')
+                            elif int(media.viewOffset)*10000 - \
+                                emby_media.PlaybackPositionTicks < 0:
                                 await media.timeline(emby_media.convertTime(
                                     emby_media.PlaybackPositionTicks))
                                 log.info(f'Plex服务器已同步进度：{media.title}')
-                            elif emby_media.Played:
-                                await media.watched()
-                                log.info(f'Plex服务器已观看：{media.title}')
-                    #剧集同步
-                    elif isinstance(media,Show) and isinstance(emby_media,embyserver.Show):
-                        #获取剧集集数
-                        emby_eps = await emby_media.episodes()
-                        #判断剧集内的集数，emby或者plex是否有观看集数
-                        if media.viewCount or emby_media.check_played():
-                            plex_eps = await media.episodes()
-                            for plex_ep in plex_eps:
-                                exist = False
-                                #遍历匹配对应集数
-                                for emby_ep in emby_eps:
-                                    if plex_ep.parentIndex == emby_ep.ParentIndexNumber \
-                                        and plex_ep.index == emby_ep.IndexNumber:
-                                        exist = True
-                                        #集数匹配成功，情况1：都观看了
-                                        if plex_ep.viewCount and emby_ep.Played:
-                                            pass
-                                        #情况2：plex观看而emby未观看
-                                        elif plex_ep.viewCount and not emby_ep.Played:
-                                            await emby_ep.watched()
-                                            log.info(
-                                            f'{media.title}.{plex_ep.pretty_ep_out()}：Emby已观看')
-                                        #情况3：plex或者emby其中有一个未看完
-                                        elif plex_ep.viewOffset or emby_ep.PlaybackPositionTicks != 0:
-                                            #判断是否是plex未看完
-                                            if plex_ep.viewOffset is None:
-                                                plex_ep.viewOffset = 0
-                                            #通过减法，判断plex和emby进度条长短
-                                            if int(plex_ep.viewOffset)*10000 - \
-                                                emby_ep.PlaybackPositionTicks > 0:
-                                                await emby_ep.timeline(
-                                                    plex_ep.convertTime(plex_ep.viewOffset))
-                                                log.info(
-                                            f'{media.title}.{plex_ep.pretty_ep_out()}：Emby已同步进度')
-                                            elif int(plex_ep.viewOffset)*10000 - \
-                                                emby_ep.PlaybackPositionTicks < 0:
-                                                await plex_ep.timeline(emby_ep.convertTime(
-                                                    emby_ep.PlaybackPositionTicks))
-                                                log.info(
-                                            f'{media.title}.{plex_ep.pretty_ep_out()}：Plex已同步进度')
-                                        #情况4：plex未观看，emby观看
-                                        elif not plex_ep.viewCount and emby_ep.Played:
-                                            await plex_ep.watched()
-                                            log.info(
-                                            f'{media.title}.{plex_ep.pretty_ep_out()}：Plex已观看')
-                                        #情况5：都未观看
-                                        elif not plex_ep.viewCount and not emby_ep.Played:
-                                            log.info(
-                                            f'{media.title}.{plex_ep.pretty_ep_out()}：Plex,Emby都未观看')
-                                        #其余情况放入报错日志待议
-                                        else:
-                                            log.error(
-                                        f'someting wrong:{media.title}.{plex_ep.pretty_ep_out()},plex:-{plex_ep.viewCount}-{plex_ep.viewOffset},emby:-{emby_ep.Played}-{emby_ep.PlaybackPositionTicks}')
-                                        #移除匹配成功集数
-                                        emby_eps.remove(emby_ep)
-                                        break
-                                #集数匹配失败
-                                if not exist:
-                                    log.info(f'{media.title}.{plex_ep.pretty_ep_out()}:：未在Emby中存在')
-                            #匹配完后，emby的集数有残留，plex未存在
-                            if emby_eps:
-                                for emby_ep in emby_eps:
-                                    log.info(f'{media.title}.{emby_ep.pretty_ep_out()}:：未在Plex中存在')
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                pass
-            except:
-                log.error(f'{media.title}\{emby_media.Name}同步失败 ：\n {traceback.format_exc()}')
+                        elif not media.viewCount and emby_media.Played:
+                            await media.watched()
+                            log.info(f'Plex服务器已观看：{media.title}')
+                        else:
+                            log.warning(f'someting wrong:{media.title}')
+                    else:
+                        #若判断plex未看过，接下来判断emby是否看过
+                        if emby_media.PlaybackPositionTicks != 0:
+                            await media.timeline(emby_media.convertTime(
+                                emby_media.PlaybackPositionTicks))
+                            log.info(f'Plex服务器已同步进度：{media.title}')
+                        elif emby_media.Played:
+                            await media.watched()
+                            log.info(f'Plex服务器已观看：{media.title}')
+                #剧集同步
+                elif isinstance(media,Show) and isinstance(emby_media,embyserver.Show):
+                    #获取剧集集数
+                    emby_eps = await emby_media.episodes()
+                    #判断剧集内的集数，emby或者plex是否有观看集数
+                    if media.viewCount or emby_media.check_played():
+                        plex_eps = await media.episodes()
+                        #按(季,集)哈希匹配，一次得到两边未匹配的集
+                        pairs,plex_only,emby_only = match(plex_eps,emby_eps,
+                                                          lambda ep: ep.episode_key(),
+                                                          lambda ep: ep.episode_key())
+                        for plex_ep,emby_ep in pairs:
+                            await self._sync_episode(media,plex_ep,emby_ep)
+                        #集数匹配失败
+                        for plex_ep in plex_only:
+                            log.info(f'{media.title}.{plex_ep.pretty_ep_out()}:：未在Emby中存在')
+                        #emby的集数有残留，plex未存在
+                        for emby_ep in emby_only:
+                            log.info(f'{media.title}.{emby_ep.pretty_ep_out()}:：未在Plex中存在')
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.error(f'{media.title}\{emby_media.Name}同步失败 ：\n {traceback.format_exc()}')
+
+    async def _plex_medias(self):
+        library = await self.plex.library()
+        sections = library.sections()
+        for section in sections:
+            async for media in section.iter_all(fields=self.PLEX_FIELDS):
+                yield media
+
+    @classmethod
+    def _provider_keys(cls,ids:dict) -> list:
+        """
+            {'tmdb':..,'imdb':..,'tvdb':..} -> [(provider,id)]，imdb只保留数字，和plex一致
+        """
+        keys = []
+        for provider in cls.PROVIDERS:
+            pid = ids.get(provider)
+            if provider == 'imdb' and pid:
+                pid = ''.join(ch for ch in str(pid) if ch.isdigit())
+            if pid:
+                keys.append((provider,str(pid)))
+        return keys
+
+    def _join(self,plex_items:list,emby_items:list) -> dict:
+        """
+            按刮削ID连接两边的剧集或电影，返回{plex ratingKey: [emby Id]}
+            plex_items，emby_items：[(条目,刮削ID字典)]
+        """
+        index = {}
+        for media,ids in emby_items:
+            for key in self._provider_keys(ids):
+                index.setdefault(key,[]).append(media.Id)
+        result = {}
+        for media,ids in plex_items:
+            for key in self._provider_keys(ids):
+                if key in index:
+                    result[media.ratingKey] = index[key]
+                    break
+        return result
+
+    async def _plex_state(self):
+        """
+            plex：所有剧集和电影的刮削ID，已观看或观看中的集
+        """
+        shows,movies,episodes = [],[],{}
+        library = await self.plex.library()
+        for section in library.sections():
+            if section.type == 'show':
+                async for show in section.iter_all(fields=self.PLEX_SHOW_FIELDS,includeGuids=1):
+                    shows.append((show,guid_ids(show.data.get('Guid'))))
+                for filter in ({'unwatched':0},{'inProgress':1}):
+                    async for ep in section.iter_episodes(fields=self.PLEX_EPISODE_FIELDS,**filter):
+                        episodes[ep.ratingKey] = ep
+            elif section.type == 'movie':
+                async for movie in section.iter_all(fields=self.PLEX_MOVIE_FIELDS,includeGuids=1):
+                    movies.append((movie,guid_ids(movie.data.get('Guid'))))
+        return shows,movies,list(episodes.values())
+
+    async def _emby_state(self):
+        """
+            emby：所有剧集和电影的刮削ID，已观看或观看中的集
+        """
+        shows,movies,episodes = [],[],{}
+        for lb in await self.emby.library():
+            if lb.CollectionType not in (None,'movies','tvshows'):
+                continue
+            async for media in lb.iter_all(fields=self.EMBY_FIELDS):
+                ids = {'tmdb':media.tmdbid,'tvdb':media.tvdbid,'imdb':media.imdbid}
+                if isinstance(media,embyserver.Show):
+                    shows.append((media,ids))
+                elif isinstance(media,embyserver.Movie):
+                    movies.append((media,ids))
+            if lb.CollectionType != 'movies':
+                for filter in ('IsPlayed','IsResumable'):
+                    async for ep in lb.iter_episodes(fields=('UserData',),Filters=filter):
+                        episodes[ep.Id] = ep
+        return shows,movies,list(episodes.values())
+
+    async def _bulk_changes(self) -> list:
+        """
+            两边各自分页拉取观看状态，在本地按刮削ID和(季,集)比对，返回需要的修改
+        """
+        (plex_shows,plex_movies,plex_eps),(emby_shows,emby_movies,emby_eps) = \
+            await asyncio.gather(self._plex_state(),self._emby_state())
+        log.info(f'{self.name}：plex有观看记录的集{len(plex_eps)}个，emby{len(emby_eps)}个，开始比对')
+        changes = []
+        #电影：两边都是全量列表，直接比对
+        plex_movie = {m.ratingKey:m for m,_ in plex_movies}
+        emby_movie = {m.Id:m for m,_ in emby_movies}
+        for plex_id,emby_ids in self._join(plex_movies,emby_movies).items():
+            movie = plex_movie[plex_id]
+            for emby_id in emby_ids:
+                change = self._diff(movie,emby_movie[emby_id])
+                if change:
+                    changes.append((change,movie.title))
+        #集：只有有观看记录的集，按(emby剧集Id,季,集)连接
+        show_map = self._join(plex_shows,emby_shows)
+        reverse = {}
+        for plex_id,emby_ids in show_map.items():
+            for emby_id in emby_ids:
+                reverse.setdefault(emby_id,[]).append(plex_id)
+        left = [((emby_id,) + ep.episode_key(),ep) for ep in plex_eps
+                for emby_id in show_map.get(ep.grandparentRatingKey,[])]
+        pairs,plex_only,emby_only = match(left,emby_eps,lambda x: x[0],
+                                          lambda ep: (ep.SeriesId,) + ep.episode_key())
+        pairs = [(x[1],emby_ep) for x,emby_ep in pairs]
+        #只有一边有观看记录：另一边按剧集取一次全部集，找到对应的集
+        emby_series = {}
+        for (emby_id,se,ep),plex_ep in plex_only:
+            if emby_id not in emby_series:
+                emby_series[emby_id] = embyserver.Show({'Id':emby_id},self.emby)
+            emby_ep = await emby_series[emby_id].episode(se,ep)
+            if emby_ep:
+                pairs.append((plex_ep,emby_ep))
+        plex_series = {}
+        for emby_ep in emby_only:
+            for plex_id in reverse.get(emby_ep.SeriesId,[]):
+                if plex_id not in plex_series:
+                    plex_series[plex_id] = Show({'ratingKey':plex_id},self.plex)
+                plex_ep = await plex_series[plex_id].episode(*emby_ep.episode_key())
+                if plex_ep:
+                    plex_ep.grandparentTitle = plex_ep.grandparentTitle or emby_ep.SeriesName
+                    pairs.append((plex_ep,emby_ep))
+        for plex_ep,emby_ep in pairs:
+            change = self._diff(plex_ep,emby_ep)
+            if change:
+                changes.append((change,f'{plex_ep.grandparentTitle}.{plex_ep.pretty_ep_out()}'))
+        return changes
+
+    async def _apply_change(self,item):
+        change,label = item
+        try:
+            await self._write(change,label)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.error(f'{label}同步失败 ：\n {traceback.format_exc()}')
+
+    async def bulksync(self):
+        log.info(f"开始批量比对plex({self.plex.name})，emby({self.emby.name})全部观看状态")
+        try:
+            changes = await self._bulk_changes()
+            log.info(f"{self.name}：比对完成，需要修改{len(changes)}处")
+            pipeline = self.pipeline(f"同步plex({self.plex.name})，emby({self.emby.name})",self._apply_change)
+            await pipeline.run(changes)
+            log.info(f"同步plex({self.plex.name})，emby({self.emby.name})全部观看历史完毕")
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.critical(f'同步plex({self.plex.name})，emby({self.emby.name})全部观看历史失败 ：\n {traceback.format_exc()}')
 
     async def synctask(self):
+        if self.bulk:
+            return await self.bulksync()
         log.info(f"开始同步plex({self.plex.name})，emby({self.plex.name})全部观看历史")
         try:
-            tasks = set()
-            library = await self.plex.library()
-            sections = library.sections()
-            for section in sections:
-                data = await section.all()
-                for media in data:
-                    future = asyncio.create_task(self._synctask(media=media))
-                    future.add_done_callback(tasks.discard)
-                    tasks.add(future)
-            await asyncio.gather(*tasks,return_exceptions=True)
+            pipeline = self.pipeline(f"同步plex({self.plex.name})，emby({self.emby.name})",self._synctask)
+            await pipeline.run(self._plex_medias())
             log.info(f"同步plex({self.plex.name})，emby({self.plex.name})全部观看历史完毕")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
         except:
             log.critical(f'同步plex({self.plex.name})，emby({self.plex.name})全部观看历史失败 ：\n {traceback.format_exc()}')
 
-    async def _plex_sync_emby(self,media):
+    async def _send(self,change,label:str):
+        """
+            轮询的写入：写入后推进目标服务器的时间戳，下次轮询不会把自己的写入同步回去
+        """
+        await self._write(change,label)
+        target,action,_ = change
+        if target._server is self.emby:
+            name = 'last_vieweddate' if action == 'watched' else 'last_viewingdate'
+            stamp = target.LastPlayedDate
+        else:
+            name = 'last_viewed' if action == 'watched' else 'last_viewing'
+            stamp = int(time.time())
+        async with self.lock:
+            if hasattr(self,name) and getattr(self,name) < stamp:
+                setattr(self,name,stamp)
+
+    @staticmethod
+    def _timestamp(stamp) -> float:
+        #emby的时间为不带时区的utc时间
+        if isinstance(stamp,datetime.datetime):
+            return stamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return stamp
+
+    def _advance(self,name:str,stamp):
+        if hasattr(self,name) and getattr(self,name) < stamp:
+            setattr(self,name,stamp)
+
+    def _rewind(self,name:str,stamp):
+        """
+            事件没有同步成功，时间戳退回到该事件之前，下次轮询重新获取
+        """
+        if isinstance(stamp,datetime.datetime):
+            stamp = stamp - datetime.timedelta(microseconds=1)
+        else:
+            stamp = stamp - 1
+        if hasattr(self,name) and getattr(self,name) > stamp:
+            setattr(self,name,stamp)
+
+    async def _queue(self,change,label:str,journal=None,mark=None,poll:bool=False):
+        """
+            轮询(poll)的写入在同步进度期间先进入写缓冲，同一条目只写最终状态，写入成功后推进时间戳；
+            事件驱动的写入直接写入，只记journal和回声，时间戳只由轮询推进，漏掉的事件轮询还能取到
+            journal：写入成功后记入journal的事件，mark：写入成功后推进的来源时间戳(名称,时间)
+        """
+        if not poll:
+            await self._write(change,label)
+            if journal:
+                self.journal.record(*journal)
+            return
+        def done():
+            if mark:
+                self._advance(*mark)
+            if journal:
+                self.journal.record(*journal)
+        if not self.buffering:
+            await self._send(change,label)
+            return done()
+        target,action,_ = change
+        item = target.ratingKey if target._server is self.plex else target.Id
+        failed = (lambda: self._failed.append(mark)) if mark else None
+        if journal:
+            self._queued.add(journal)
+        self.writes.put((target._server.name,str(item)),action,lambda: self._send(change,label),
+                        label,self._timestamp(mark[1]) if mark else 0,done,failed)
+
+    async def _plex_sync_emby(self,media,journal=None,poll:bool=False):
         try:
             #判断是电视剧还是电影，通过id来匹配
             if isinstance(media,Episode):
@@ -163,65 +428,38 @@ class SyncTask(ST):
                     if isinstance(media,Movie) and isinstance(emby_media,embyserver.Movie):
                         #对于plex，若存在viewedAt参数说明已观看
                         if media.viewedAt:
-                            await emby_media.watched()
-                            #刷新重载媒体数据
-                            await emby_media.reload()
-                            #刷新Task的emby最新已观看时间戳
-                            async with self.lock:
-                                if self.last_vieweddate < emby_media.LastPlayedDate:
-                                    self.last_vieweddate = emby_media.LastPlayedDate
-                                if media.viewedAt - self.last_viewed > 0:
-                                    self.last_viewed = media.viewedAt
-                            log.info(f'Emby服务器已观看：{media.title}')
+                            await self._queue((emby_media,'watched',None),media.title,journal,('last_viewed',media.viewedAt),poll)
                         #继续观看的情况：
                         elif media.lastViewedAt:
-                            await emby_media.timeline(media.convertTime(media.viewOffset))
-                            await emby_media.reload()
-                            #刷新Task的emby最新继续观看时间戳
-                            async with self.lock:
-                                if self.last_viewingdate < emby_media.LastPlayedDate:
-                                    self.last_viewingdate = emby_media.LastPlayedDate
-                                if media.lastViewedAt - self.last_viewing > 0:
-                                    self.last_viewing = media.lastViewedAt
-                            log.info(f'Emby服务器已同步进度：{media.title}')
+                            await self._queue((emby_media,'timeline',media.convertTime(media.viewOffset)),
+                                              media.title,journal,('last_viewing',media.lastViewedAt),poll)
                     #情况2：剧集
                     elif isinstance(media,Episode) and isinstance(emby_media,embyserver.Show):
                         se_num = media.parentIndex
                         ep_num = media.index
                         #获取到对应集数
                         emby_ep = await emby_media.episode(se_num,ep_num)
+                        label = f'{p_media.title}.{media.pretty_ep_out()}'
                         #判断是否存在
                         if emby_ep:
                             #1.已观看
                             if media.viewedAt:
-                                await emby_ep.watched()
-                                await emby_ep.reload()
-                                async with self.lock:
-                                    if self.last_vieweddate < emby_ep.LastPlayedDate:
-                                        self.last_vieweddate = emby_ep.LastPlayedDate
-                                    if media.viewedAt - self.last_viewed > 0:
-                                        self.last_viewed = media.viewedAt
-                                log.info(f'{p_media.title}.{media.pretty_ep_out()}：Emby已观看')
+                                await self._queue((emby_ep,'watched',None),label,journal,('last_viewed',media.viewedAt),poll)
                             #2.继续观看
                             elif media.lastViewedAt:
-                                await emby_ep.timeline(media.convertTime(media.viewOffset))
-                                await emby_ep.reload()
-                                async with self.lock:
-                                    if self.last_viewingdate < emby_ep.LastPlayedDate:
-                                        self.last_viewingdate = emby_ep.LastPlayedDate
-                                    if media.lastViewedAt - self.last_viewing > 0:
-                                        self.last_viewing = media.lastViewedAt
-                                log.info(f'{p_media.title}.{media.pretty_ep_out()}：Emby已同步进度')
+                                await self._queue((emby_ep,'timeline',media.convertTime(media.viewOffset)),
+                                                  label,journal,('last_viewing',media.lastViewedAt),poll)
                         else:
-                            log.warning(f'{p_media.title}.{media.pretty_ep_out()}：Emby无该集')
+                            log.warning(f'{label}：Emby无该集')
             else:
                 log.warning(f'{p_media.title}：Emby无该影视')
+            return True
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
         except:
             log.critical(f'Plex同步Emby播放进度失败{media.title} ：\n {traceback.format_exc()}')
 
-    async def _emby_sync_plex(self,media):
+    async def _emby_sync_plex(self,media,journal=None,poll:bool=False):
         try:
             if isinstance(media,embyserver.Episode):
                 p_media = await media.GetShow()
@@ -233,65 +471,194 @@ class SyncTask(ST):
                 for plex_media in plex_medias:
                     if isinstance(media,embyserver.Movie) and isinstance(plex_media,Movie):
                         if media.PlaybackPositionTicks:
-                            await plex_media.timeline(media.convertTime(media.PlaybackPositionTicks))
-                            await plex_media.fetchitem()
-                            async with self.lock:
-                                if plex_media.lastViewedAt - self.last_viewing  > 0:
-                                    self.last_viewing = plex_media.lastViewedAt
-                                if media.LastPlayedDate > self.last_viewingdate:
-                                    self.last_viewingdate = media.LastPlayedDate
-                            log.info(f'Plex服务器已同步进度：{media.Name}')
+                            await self._queue((plex_media,'timeline',media.convertTime(media.PlaybackPositionTicks)),
+                                              media.Name,journal,('last_viewingdate',media.LastPlayedDate),poll)
                         elif media.Played:
-                            await plex_media.watched()
-                            await plex_media.fetchitem()
-                            async with self.lock:
-                                if plex_media.lastViewedAt - self.last_viewed  > 0:
-                                    self.last_viewed = plex_media.lastViewedAt
-                                if media.LastPlayedDate > self.last_vieweddate:
-                                    self.last_vieweddate = media.LastPlayedDate
-                            log.info(f'Plex服务器已观看：{media.Name}')
+                            await self._queue((plex_media,'watched',None),media.Name,journal,('last_vieweddate',media.LastPlayedDate),poll)
                     elif isinstance(media,embyserver.Episode) and isinstance(plex_media,Show):
                         se_num = media.ParentIndexNumber
                         ep_num = media.IndexNumber
                         plex_ep = await plex_media.episode(se_num,ep_num)
+                        label = f'{p_media.Name}.{media.pretty_ep_out()}'
                         if plex_ep:
                             if media.PlaybackPositionTicks:
-                                await plex_ep.timeline(media.convertTime(media.PlaybackPositionTicks))
-                                await plex_media.fetchitem()
-                                async with self.lock:
-                                    if plex_media.lastViewedAt - self.last_viewing  > 0:
-                                        self.last_viewing = plex_media.lastViewedAt
-                                    if media.LastPlayedDate > self.last_viewingdate:
-                                        self.last_viewingdate = media.LastPlayedDate
-                                log.info(f'{p_media.Name}.{media.pretty_ep_out()}：Plex已同步进度')
+                                await self._queue((plex_ep,'timeline',media.convertTime(media.PlaybackPositionTicks)),
+                                                  label,journal,('last_viewingdate',media.LastPlayedDate),poll)
                             elif media.Played:
-                                await plex_ep.watched()
-                                await plex_media.fetchitem()
-                                async with self.lock:
-                                    if plex_media.lastViewedAt - self.last_viewed  > 0:
-                                        self.last_viewed = plex_media.lastViewedAt
-                                    if media.LastPlayedDate > self.last_vieweddate:
-                                        self.last_vieweddate = media.LastPlayedDate
-                                log.info(f'{p_media.Name}.{media.pretty_ep_out()}：Plex已观看')
+                                await self._queue((plex_ep,'watched',None),label,journal,('last_vieweddate',media.LastPlayedDate),poll)
                         else:
-                            log.warning(f'{p_media.Name}.{media.pretty_ep_out()}：Plex无该集')
+                            log.warning(f'{label}：Plex无该集')
             else:
                 log.warning(f'{p_media.Name}：Plex无该影视')
+            return True
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
         except:
             log.critical(f'Emby同步Plex播放进度失败{media.Name} ：\n {traceback.format_exc()}')
     
+    def _mark(self,server,item):
+        self._written[(server.name,str(item))] = time.monotonic() + self.ECHO_SECONDS
+
+    def _is_echo(self,server,item) -> bool:
+        key = (server.name,str(item))
+        expire = self._written.get(key)
+        if expire is None:
+            return False
+        if expire < time.monotonic():
+            del self._written[key]
+            return False
+        return True
+
+    def on_event(self,server,event:str,item):
+        """
+            webhook入口：server为收到事件的服务器，item为ratingKey或Id
+        """
+        if server is not self.plex and server is not self.emby:
+            return
+        if self._is_echo(server,item):
+            log.debug(f'{server.name}：{item} {event} 为同步产生的事件，忽略')
+            return
+        key = (server.name,str(item))
+        first = key not in self._events
+        self._events[key] = event
+        if first:
+            future = asyncio.ensure_future(self._handle_event(server,key))
+            future.add_done_callback(self._event_tasks.discard)
+            self._event_tasks.add(future)
+
+    def on_userdata(self,server,ids:list):
+        """
+            websocket推送的观看数据变化
+        """
+        for id in ids:
+            self.on_event(server,'UserDataChanged',id)
+
+    async def _handle_event(self,server,key):
+        await asyncio.sleep(self.EVENT_DELAY)
+        event = self._events.pop(key)
+        if server is self.plex:
+            await self.sync_plex_item(key[1],event)
+        else:
+            await self.sync_emby_item(key[1],event)
+
+    async def sync_plex_item(self,ekey,event:str=None):
+        """
+            同步plex单个电影或单集到emby
+        """
+        try:
+            media = await self.plex.get_item(ekey)
+            if media is None:
+                return
+            #以获取到的观看数据为准，不看事件名(webhook事件可能来自其他用户)
+            if media.viewCount and not media.viewOffset:
+                #和历史记录一样用viewedAt表示已观看
+                media.viewedAt = media.lastViewedAt or int(time.time())
+                action,stamp = 'watched',media.viewedAt
+            elif media.viewOffset:
+                media.lastViewedAt = media.lastViewedAt or int(time.time())
+                action,stamp = 'progress',media.lastViewedAt
+            else:
+                return
+            #记入journal，轮询再取到同一个事件时跳过
+            await self._apply(self.plex,media.ratingKey,action,stamp,self._plex_sync_emby,media)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.error(f'Plex({self.plex.name})条目{ekey}同步失败 ：\n {traceback.format_exc()}')
+
+    async def sync_emby_item(self,id,event:str=None):
+        """
+            同步emby单个电影或单集到plex
+        """
+        try:
+            media = await self.emby.get_item(id)
+            if media is None:
+                return
+            if getattr(media,'PlaybackPositionTicks',None):
+                action = 'progress'
+            elif getattr(media,'Played',None):
+                action = 'watched'
+            else:
+                return
+            if not hasattr(media,'LastPlayedDate'):
+                #和emby返回的LastPlayedDate一样为不带时区的utc时间
+                media.LastPlayedDate = datetime.datetime.utcnow()
+            await self._apply(self.emby,media.Id,action,media.LastPlayedDate.isoformat(),self._emby_sync_plex,media)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        except:
+            log.error(f'Emby({self.emby.name})条目{id}同步失败 ：\n {traceback.format_exc()}')
+
+    def _load_marks(self):
+        """
+            恢复上次保存的同步时间戳，停机期间的观看记录重启后依然会同步
+        """
+        marks = self.state.get('synctask',self.name) or {}
+        for name in ('last_viewing','last_viewed'):
+            if marks.get(name) is not None and not hasattr(self,name):
+                setattr(self,name,marks[name])
+        for name in ('last_viewingdate','last_vieweddate'):
+            if marks.get(name) is not None and not hasattr(self,name):
+                setattr(self,name,datetime.datetime.fromisoformat(marks[name]))
+        if marks:
+            log.info(f'{self.name}：从上次的同步位置继续')
+
+    def _save_marks(self):
+        marks = {}
+        for name in self.MARKS:
+            value = getattr(self,name,None)
+            if isinstance(value,datetime.datetime):
+                value = value.isoformat()
+            marks[name] = value
+        self.state.set('synctask',self.name,marks)
+
+    async def _apply(self,server,item,action,stamp,sync,media,poll:bool=False):
+        """
+            同步一个观看事件，成功后记入journal，已记录的事件跳过；poll为轮询取到的事件
+        """
+        key = (self.name,server.name,item,action,stamp)
+        if self.journal.seen(*key):
+            return
+        #进入写缓冲的写入在实际写入成功后才记入journal
+        queued = self.buffering and poll
+        if await sync(media,journal=key,poll=poll):
+            #没有产生写入的事件(对端无该影视，无该集)也记入journal，下次轮询不再重复查找
+            if not queued or key not in self._queued:
+                self.journal.record(*key)
+        elif queued:
+            #同步出错，该事件下次轮询重新获取
+            if isinstance(stamp,str):
+                stamp = datetime.datetime.fromisoformat(stamp)
+            self._failed.append((self.SOURCE_MARKS[(server.type,action)],stamp))
+
+    async def _flush(self):
+        """
+            写出缓冲，失败的事件退回时间戳，再保存时间戳
+        """
+        try:
+            await self.writes.flush()
+        finally:
+            failed,self._failed = self._failed,[]
+            self._queued = set()
+            async with self.lock:
+                for name,stamp in failed:
+                    self._rewind(name,stamp)
+                if all(hasattr(self,name) for name in self.MARKS):
+                    self._save_marks()
+
     async def cronsync(self):
+        self.buffering = True
         try:
             log.info(f'{self.plex.name} / {self.emby.name}：开始同步进度')
             tasks = set()
-            #获取plex，emby最近观看记录和继续观看
-            plex_history = await self.plex.history()
-            plex_cont = await self.plex.hub_continue()
-            emby_history = await self.emby.history()
-            emby_cont = await self.emby.hub_continue()
-            #初始化参数
+            async with self.lock:
+                self._load_marks()
+            #获取plex，emby最近观看记录和继续观看，有时间戳时只分页获取之后的记录
+            plex_history = await self.plex.history(since=getattr(self,'last_viewed',None))
+            plex_cont = await self.plex.hub_continue(since=getattr(self,'last_viewing',None))
+            emby_history = await self.emby.history(since=getattr(self,'last_vieweddate',None))
+            emby_cont = await self.emby.hub_continue(since=getattr(self,'last_viewingdate',None))
+            #初始化参数，优先使用上次保存的时间戳
             async with self.lock:
                 if not hasattr(self,'last_viewing'):
                     #plex最新继续观看时间戳
@@ -306,14 +673,15 @@ class SyncTask(ST):
                         self.last_viewed = int(time.time())
                 if not hasattr(self,'last_viewingdate'):
                     #emby最新继续观看时间戳
-                    self.last_viewingdate = emby_cont[0].LastPlayedDate if emby_cont else datetime.datetime.now(tz=datetime.timezone.utc)
+                    self.last_viewingdate = emby_cont[0].LastPlayedDate if emby_cont else datetime.datetime.utcnow()
                 if not hasattr(self,'last_vieweddate'):
                     #emby最新已观看时间戳
-                    self.last_vieweddate = emby_history[0].LastPlayedDate if emby_history else datetime.datetime.now(tz=datetime.timezone.utc)
+                    self.last_vieweddate = emby_history[0].LastPlayedDate if emby_history else datetime.datetime.utcnow()
             #递归判断,所有新增plex继续观看
             for _cont in plex_cont:
                 if _cont.lastViewedAt - self.last_viewing > 0:
-                    future = asyncio.create_task(self._plex_sync_emby(media=_cont))
+                    future = asyncio.create_task(self._apply(self.plex,_cont.ratingKey,'progress',
+                                                             _cont.lastViewedAt,self._plex_sync_emby,_cont,True))
                     future.add_done_callback(tasks.discard)
                     tasks.add(future)
                 else:
@@ -323,7 +691,8 @@ class SyncTask(ST):
                 if not _his.viewedAt:
                     _his.viewedAt = _his.lastViewedAt
                 if _his.viewedAt - self.last_viewed > 0:
-                    future = asyncio.create_task(self._plex_sync_emby(media=_his))
+                    future = asyncio.create_task(self._apply(self.plex,_his.ratingKey,'watched',
+                                                             _his.viewedAt,self._plex_sync_emby,_his,True))
                     future.add_done_callback(tasks.discard)
                     tasks.add(future)
                 else:
@@ -331,7 +700,8 @@ class SyncTask(ST):
             #所有新增emby已观看
             for _his in emby_history:
                 if _his.LastPlayedDate > self.last_vieweddate:
-                    future = asyncio.create_task(self._emby_sync_plex(media=_his))
+                    future = asyncio.create_task(self._apply(self.emby,_his.Id,'watched',
+                                                             _his.LastPlayedDate.isoformat(),self._emby_sync_plex,_his,True))
                     future.add_done_callback(tasks.discard)
                     tasks.add(future)
                 else:
@@ -339,14 +709,25 @@ class SyncTask(ST):
             #所有新增emby继续观看
             for _cont in emby_cont:
                 if _cont.LastPlayedDate > self.last_viewingdate:
-                    future = asyncio.create_task(self._emby_sync_plex(media=_cont))
+                    future = asyncio.create_task(self._apply(self.emby,_cont.Id,'progress',
+                                                             _cont.LastPlayedDate.isoformat(),self._emby_sync_plex,_cont,True))
                     future.add_done_callback(tasks.discard)
                     tasks.add(future)
                 else:
                     break
             await asyncio.gather(*tasks,return_exceptions=True)
+            self.journal.trim(self.JOURNAL_DAYS)
             log.info(f"{self.plex.name} / {self.emby.name}：同步进度完毕，等待下一次运行")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
         except:
-            log.critical(f'{self.plex.name} / {self.emby.name}同步进度失败 ：\n {traceback.format_exc()}')
\ No newline at end of file
+            log.critical(f'{self.plex.name} / {self.emby.name}同步进度失败 ：\n {traceback.format_exc()}')
+        finally:
+            #出错时也写出已缓冲的写入，同一条目只写最终状态，已观看先写；之后的事件直接写入
+            self.buffering = False
+            try:
+                await self._flush()
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                pass
+            except:
+                log.error(f'{self.plex.name} / {self.emby.name}写入同步进度失败 ：\n {traceback.format_exc()}')
\ No newline at end of file
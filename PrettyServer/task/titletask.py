@@ -1,20 +1,36 @@
 import asyncio
 import traceback
+from functools import partial
 import server.embyserver as embyserver
 from task.base import TitleTask as TT
 from util.log import log
+from util.ratelimit import PRIORITY_BULK,PRIORITY_SYNC
 
 class TitleTask(TT):
+    #剧集只需要tmdbid
+    FIELDS = ('ProviderIds',)
+    #季只需要Id，Name，IndexNumber，SeriesId
+    SEASON_FIELDS = ()
+
     def __init__(self, mediaserver, task_info: dict) -> None:
         super().__init__(mediaserver, task_info)
 
-    async def _emby_season_title(self,media):
+    async def _emby_season_title(self,item,priority:int=PRIORITY_BULK):
+        """
+            item: (剧集, 季列表)，季列表为None时单独请求该剧集的季
+            priority: tmdb请求优先级，推送触发的优先
+        """
+        media,seasons = item
         try:
             if not media.tmdbid:
                 log.warning(f"Emby: {media.Name} 没有tmdbid，无法搜索季标题，跳过")
                 return
-            for se in await media.seasons():
-                title = await media.season_title(media.tmdbid,se.IndexNumber)
+            if seasons is None:
+                seasons = await media.seasons()
+            #所有季合并成一次tmdb请求
+            titles = await media.season_titles(media.tmdbid,[se.IndexNumber for se in seasons],priority)
+            for se in seasons:
+                title = titles.get(se.IndexNumber)
                 if title:
                     if se.Name == title:
                         log.info(f'Emby: {media.Name}: 季{se.IndexNumber} 已存在标题{title}')
@@ -28,25 +44,45 @@ class TitleTask(TT):
         except:
             log.critical(f'Emby修正季标题任务任务失败 {media.Name}：{traceback.format_exc()}')
 
+    async def _medias(self):
+        emby_library = await self.server.library()
+        for lb in emby_library:
+            if isinstance(lb,embyserver.MixContent):
+                data = lb.iter_series(self.FIELDS)
+            elif isinstance(lb,embyserver.SeriesLibrary):
+                data = lb.iter_all(self.FIELDS)
+            else:
+                log.warning(f'{lb.Name}：修正季标题只支持剧集和混合内容库，跳过此库')
+                continue
+            #整个库的季分页一次性取回，按SeriesId分组，代替每个剧集单独请求
+            seasons = {}
+            async for se in lb.iter_seasons(self.SEASON_FIELDS):
+                seasons.setdefault(se.SeriesId,[]).append(se)
+            async for media in data:
+                yield (media,seasons.pop(media.Id,[]))
+
+    async def run_items(self,ids:list):
+        """
+            只处理推送过来的剧集，推送的是季时处理所属剧集
+        """
+        medias = await self.server.get_medias(ids)
+        shows = {m.Id:m for m in medias if isinstance(m,embyserver.Show)}
+        series_ids = {m.SeriesId for m in medias if isinstance(m,embyserver.Season)} - set(shows)
+        if series_ids:
+            for m in await self.server.get_medias(list(series_ids)):
+                if isinstance(m,embyserver.Show):
+                    shows[m.Id] = m
+        if shows:
+            log.info(f"Emby({self.server.name})：{len(shows)}个剧集有变化，开始修正季标题")
+            pipeline = self.pipeline(f"Emby({self.server.name})修正季标题",
+                                     partial(self._emby_season_title,priority=PRIORITY_SYNC))
+            await pipeline.run([(media,None) for media in shows.values()])
+
     async def run(self):
         log.info(f"Emby({self.server.name})：开始进行修正季标题任务...")
         try:
-            tasks = set()
-            emby_library = await self.server.library()
-            for lb in emby_library:
-                if isinstance(lb,embyserver.MixContent):
-                    data = await lb.get_series()
-                elif isinstance(lb,embyserver.SeriesLibrary):
-                    data = await lb.all()
-                else:
-                    log.warning(f'{lb.Name}：修正季标题只支持剧集和混合内容库，跳过此库')
-                    continue
-                for media in data:
-                    future = asyncio.create_task(self._emby_season_title(media=media))
-                    future.add_done_callback(tasks.discard)
-                    tasks.add(future)
-                
-            await asyncio.gather(*tasks,return_exceptions=True)
+            pipeline = self.pipeline(f"Emby({self.server.name})修正季标题",self._emby_season_title)
+            await pipeline.run(self._medias())
             log.info(f"Emby({self.server.name})：修正季标题任务任务执行完毕")
         except (asyncio.CancelledError, KeyboardInterrupt):
             pass
@@ -0,0 +1,78 @@
+import asyncio
+import copy
+from conf.conf import BATCH
+from util.metrics import metrics
+
+class BatchLoader():
+    """
+        微批加载：在delay秒内收集调用者的key，凑够size个或到时间就合并成一次请求，
+        再把结果按key分发回各个调用者；同一个key同时只请求一次
+    """
+    def __init__(self,name:str,loader,size:int=None,delay:float=None) -> None:
+        """
+            loader: async def loader(keys:list) -> {key: 结果}，没有结果的key可以不返回
+        """
+        self.name = name
+        self.loader = loader
+        self.size = size or BATCH.get('size',50)
+        self.delay = delay if delay is not None else BATCH.get('delay',0.05)
+        self._pending = {}
+        self._queue = []
+        self._timer = None
+        #统计
+        self.batches = 0
+        self.keys = 0
+        self.shared = 0
+        metrics.register(f'batch.{name}',self.stats)
+
+    async def load(self,key):
+        call = self._pending.get(key)
+        if call is not None:
+            self.shared += 1
+            call[1] += 1
+            result = await asyncio.shield(call[0])
+            return copy.deepcopy(result)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        call = [future,0]
+        self._pending[key] = call
+        self._queue.append(key)
+        if len(self._queue) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay,self._flush)
+        result = await asyncio.shield(future)
+        #有共享者时各自拿副本，避免互相修改
+        return copy.deepcopy(result) if call[1] else result
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            keys = self._queue[:self.size]
+            self._queue = self._queue[self.size:]
+            asyncio.ensure_future(self._dispatch(keys))
+
+    async def _dispatch(self,keys:list):
+        self.batches += 1
+        self.keys += len(keys)
+        try:
+            results = await self.loader(keys)
+        except BaseException as e:
+            for key in keys:
+                call = self._pending.pop(key,None)
+                if call and not call[0].done():
+                    call[0].set_exception(e)
+                    call[0].exception()
+            if not isinstance(e,Exception):
+                raise
+        else:
+            for key in keys:
+                call = self._pending.pop(key,None)
+                if call and not call[0].done():
+                    call[0].set_result(results.get(key))
+
+    def stats(self) -> dict:
+        return {'batches':self.batches,'keys':self.keys,'shared':self.shared,
+                'pending':len(self._pending)}
@@ -0,0 +1,44 @@
+import asyncio
+import traceback
+from util.log import log
+from util.metrics import metrics
+
+class EventBus():
+    """
+        进程内事件总线：websocket等事件源发布，任务订阅，
+        处理函数可以是普通函数或协程，协程在后台运行
+    """
+    def __init__(self) -> None:
+        self._handlers = {}
+        self._tasks = set()
+        self.published = {}
+        metrics.register('events',self.stats)
+
+    def subscribe(self,topic:str,handler):
+        self._handlers.setdefault(topic,[]).append(handler)
+
+    def publish(self,topic:str,*args):
+        self.published[topic] = self.published.get(topic,0) + 1
+        for handler in self._handlers.get(topic,[]):
+            try:
+                result = handler(*args)
+            except Exception:
+                log.error(f'事件{topic}处理失败：{traceback.format_exc()}')
+                continue
+            if asyncio.iscoroutine(result):
+                future = asyncio.ensure_future(self._run(topic,result))
+                future.add_done_callback(self._tasks.discard)
+                self._tasks.add(future)
+
+    async def _run(self,topic,coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.error(f'事件{topic}处理失败：{traceback.format_exc()}')
+
+    def stats(self) -> dict:
+        return dict(self.published)
+
+bus = EventBus()
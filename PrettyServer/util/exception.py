@@ -12,7 +12,9 @@ class MediaTypeError(BaseException):
     pass
 
 class FailRequest(BaseException):
-    pass
+    def __init__(self,msg:str=None,status:int=None) -> None:
+        super().__init__(msg)
+        self.status = status
 
 class AsyncError(BaseException):
     pass
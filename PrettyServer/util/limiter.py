@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import time
+from conf.conf import CONCURRENCY,CONCURRENT_NUM
+from util.metrics import metrics
+
+class AdaptiveLimiter():
+    """
+        单个上游的自适应并发数(AIMD)：
+        延迟正常且并发用满时每轮加1，出错(429，5xx，超时)或延迟明显变高时按比例减小
+    """
+    def __init__(self,name:str,conf:dict) -> None:
+        self.name = name
+        self.min_limit = conf.get('min',2)
+        self.max_limit = conf.get('max',CONCURRENT_NUM)
+        self.limit = float(min(max(conf.get('initial',10),self.min_limit),self.max_limit))
+        #延迟超过基准延迟多少倍算变差
+        self.tolerance = conf.get('tolerance',2.0)
+        #延迟变差时的缩小比例
+        self.backoff = conf.get('backoff',0.9)
+        #出错时的缩小比例
+        self.error_backoff = conf.get('error_backoff',0.5)
+        self.inflight = 0
+        self._waiters = collections.deque()
+        #最近延迟(指数平均)和基准延迟
+        self.latency = None
+        self.baseline = None
+        self._last_drop = 0
+        #统计
+        self.drops = 0
+        self.errors = 0
+
+    async def acquire(self):
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                #已经分到名额但被取消，还回去
+                self.release()
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            raise
+
+    def release(self,latency:float=None,healthy:bool=None):
+        """
+            healthy为None时只归还名额，不参与调整(如请求被取消)
+        """
+        saturated = self.inflight >= int(self.limit)
+        self.inflight -= 1
+        if healthy is not None:
+            self._update(latency,healthy,saturated)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.inflight += 1
+                future.set_result(None)
+
+    def _update(self,latency:float,healthy:bool,saturated:bool):
+        if not healthy:
+            self.errors += 1
+            self._drop(self.error_backoff)
+            return
+        self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+        #基准取平均延迟的最低值，并缓慢上浮，以适应上游本身变慢
+        if self.baseline is None:
+            self.baseline = self.latency
+        else:
+            self.baseline = min(self.baseline * 1.0002,self.latency)
+        if self.latency > self.baseline * self.tolerance:
+            self._drop(self.backoff)
+        elif saturated:
+            self.limit = min(self.max_limit,self.limit + 1 / self.limit)
+
+    def _drop(self,factor:float):
+        now = time.monotonic()
+        #一个往返时间内只减一次，避免同一批请求把并发数连续减到底
+        if now - self._last_drop < (self.latency or 0):
+            return
+        self._last_drop = now
+        self.drops += 1
+        self.limit = max(self.min_limit,self.limit * factor)
+
+    def stats(self) -> dict:
+        return {'limit':int(self.limit),'inflight':self.inflight,'waiting':len(self._waiters),
+                'latency_ms':int((self.latency or 0) * 1000),'baseline_ms':int((self.baseline or 0) * 1000),
+                'drops':self.drops,'errors':self.errors}
+
+class LimiterRegistry():
+    """
+        按上游名称管理并发数，Env.concurrency下可按plex/emby/tmdb单独覆盖
+    """
+    def __init__(self,conf:dict) -> None:
+        self._conf = conf
+        self._limiters = {}
+        metrics.register('concurrency',self.stats)
+
+    def limiter(self,name:str,kind:str=None) -> AdaptiveLimiter:
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            conf = {k:v for k,v in self._conf.items() if not isinstance(v,dict)}
+            if kind and isinstance(self._conf.get(kind),dict):
+                conf.update(self._conf.get(kind))
+            limiter = AdaptiveLimiter(name,conf)
+            self._limiters[name] = limiter
+        return limiter
+
+    def stats(self) -> dict:
+        return {name:l.stats() for name,l in self._limiters.items()}
+
+limits = LimiterRegistry(CONCURRENCY)
@@ -0,0 +1,30 @@
+def index_by(items,key) -> dict:
+    """
+        按key建立字典，key重复时保留第一个
+    """
+    index = {}
+    for item in items:
+        index.setdefault(key(item),item)
+    return index
+
+def match(left,right,lkey,rkey):
+    """
+        按key做哈希连接，一次遍历返回(配对列表[(左,右)], 左侧未匹配, 右侧未匹配)
+        key重复时按出现顺序一一配对
+    """
+    index = {}
+    for n,item in enumerate(right):
+        index.setdefault(rkey(item),[]).append(n)
+    pairs = []
+    left_only = []
+    matched = set()
+    for item in left:
+        bucket = index.get(lkey(item))
+        if bucket:
+            n = bucket.pop(0)
+            matched.add(n)
+            pairs.append((item,right[n]))
+        else:
+            left_only.append(item)
+    right_only = [item for n,item in enumerate(right) if n not in matched]
+    return pairs,left_only,right_only
@@ -0,0 +1,27 @@
+from util.log import log
+
+class Metrics():
+    """
+        运行指标登记处，各模块登记一个返回dict的函数，定时输出到日志
+    """
+    def __init__(self) -> None:
+        self._sources = {}
+
+    def register(self,name:str,func):
+        self._sources[name] = func
+
+    def collect(self) -> dict:
+        data = {}
+        for name,func in self._sources.items():
+            try:
+                data[name] = func()
+            except Exception as e:
+                data[name] = {'error':str(e)}
+        return data
+
+    def report(self):
+        for name,value in self.collect().items():
+            if value:
+                log.info(f'[metrics] {name}: {value}')
+
+metrics = Metrics()
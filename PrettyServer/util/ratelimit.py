@@ -0,0 +1,109 @@
+import asyncio
+import copy
+import heapq
+import itertools
+import time
+from util.metrics import metrics
+
+#优先级，数字小的先请求：同步等实时操作在前，批量任务在后
+PRIORITY_SYNC = 0
+PRIORITY_BULK = 10
+
+class TokenBucket():
+    """
+        令牌桶：平均每秒rate个，最多攒burst个
+    """
+    def __init__(self,rate:float,burst:int=None) -> None:
+        self.rate = rate
+        self.burst = burst or max(1,int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RequestScheduler():
+    """
+        按令牌桶速率发出请求，优先级数字小的先发；
+        相同key的请求在排队或请求中时只发一次，后来者优先级更高时提前
+    """
+    def __init__(self,name:str,rate:float,burst:int=None) -> None:
+        self.bucket = TokenBucket(rate,burst)
+        self._heap = []
+        self._seq = itertools.count()
+        #key: [future, func, 优先级, 共享者数, 是否已发出]
+        self._calls = {}
+        self._dispatcher = None
+        #统计
+        self.sent = 0
+        self.deduped = 0
+        self.max_depth = 0
+        metrics.register(f'scheduler.{name}',self.stats)
+
+    async def submit(self,key,func,priority:int=0):
+        call = self._calls.get(key)
+        if call is not None:
+            self.deduped += 1
+            call[3] += 1
+            if not call[4] and priority < call[2]:
+                call[2] = priority
+                heapq.heappush(self._heap,(priority,next(self._seq),key))
+            result = await asyncio.shield(call[0])
+            return copy.deepcopy(result)
+        future = asyncio.get_running_loop().create_future()
+        call = [future,func,priority,0,False]
+        self._calls[key] = call
+        heapq.heappush(self._heap,(priority,next(self._seq),key))
+        self.max_depth = max(self.max_depth,self.depth())
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        result = await asyncio.shield(future)
+        return copy.deepcopy(result) if call[3] else result
+
+    def depth(self) -> int:
+        return sum(1 for call in self._calls.values() if not call[4])
+
+    async def _dispatch(self):
+        while self._heap:
+            priority,_,key = heapq.heappop(self._heap)
+            call = self._calls.get(key)
+            #已发出或被提前后留下的旧记录
+            if call is None or call[4] or call[2] != priority:
+                continue
+            await self.bucket.take()
+            call[4] = True
+            self.sent += 1
+            asyncio.ensure_future(self._run(key,call))
+
+    async def _run(self,key,call):
+        future = call[0]
+        try:
+            result = await call[1]()
+        except asyncio.CancelledError:
+            self._calls.pop(key,None)
+            if not future.done():
+                future.cancel()
+            raise
+        except Exception as e:
+            self._calls.pop(key,None)
+            if not future.done():
+                future.set_exception(e)
+                future.exception()
+        else:
+            self._calls.pop(key,None)
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {'queued':self.depth(),'max_queued':self.max_depth,'inflight':len(self._calls) - self.depth(),
+                'sent':self.sent,'deduped':self.deduped}
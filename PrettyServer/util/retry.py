@@ -0,0 +1,104 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+from conf.conf import RETRY
+from util.metrics import metrics
+
+#GET请求可以放心重试的状态码
+RETRY_STATUS = (429, 500, 502, 503, 504)
+#非幂等请求只在服务端明确未处理时重试，连接错误和超时不重试
+RETRY_STATUS_UNSAFE = (429, 503)
+#可以放心重试的请求方法
+IDEMPOTENT_METHODS = ('GET','HEAD','PUT','DELETE')
+
+class RetryPolicy():
+    """
+        单个上游的重试策略：指数退避 + 随机抖动，支持Retry-After，
+        每分钟重试次数受budget限制，防止上游故障时重试风暴
+    """
+    def __init__(self,name:str,conf:dict) -> None:
+        self.name = name
+        self.max_retries = conf.get('max_retries',3)
+        self.base_delay = conf.get('base_delay',0.5)
+        self.max_delay = conf.get('max_delay',30)
+        self.budget = conf.get('budget',120)
+        self._window = []
+        #统计
+        self.retries = 0
+        self.giveups = 0
+        self.status = {}
+
+    def should_retry(self,attempt:int,status:int=None,method:str='GET') -> bool:
+        """
+            status为None表示连接错误或超时；可以重试但次数或budget用完时记一次放弃
+        """
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if status is None:
+            if not idempotent:
+                return False
+        elif status not in (RETRY_STATUS if idempotent else RETRY_STATUS_UNSAFE):
+            return False
+        if attempt >= self.max_retries:
+            self.giveup()
+            return False
+        now = time.monotonic()
+        self._window = [t for t in self._window if now - t < 60]
+        if len(self._window) >= self.budget:
+            self.giveup()
+            return False
+        self._window.append(now)
+        return True
+
+    def delay(self,attempt:int,retry_after:str=None) -> float:
+        if retry_after:
+            wait = self._parse_retry_after(retry_after)
+            if wait is not None:
+                return min(wait,self.max_delay)
+        return random.uniform(0,min(self.max_delay,self.base_delay * 2 ** attempt))
+
+    def record(self,status:int=None):
+        self.retries += 1
+        key = status if status is not None else 'error'
+        self.status[key] = self.status.get(key,0) + 1
+
+    def giveup(self):
+        self.giveups += 1
+
+    def stats(self) -> dict:
+        return {'retries':self.retries,'giveups':self.giveups,'status':dict(self.status)}
+
+    @staticmethod
+    def _parse_retry_after(value:str):
+        try:
+            return max(float(value),0)
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(value)
+            return max(date.timestamp() - time.time(),0)
+        except (TypeError,ValueError):
+            return None
+
+class RetryRegistry():
+    """
+        按上游名称管理重试策略，Env.retry下可按plex/emby/tmdb单独覆盖
+    """
+    def __init__(self,conf:dict) -> None:
+        self._conf = conf
+        self._policies = {}
+        metrics.register('retry',self.stats)
+
+    def policy(self,name:str,kind:str=None) -> RetryPolicy:
+        policy = self._policies.get(name)
+        if policy is None:
+            conf = {k:v for k,v in self._conf.items() if not isinstance(v,dict)}
+            if kind and isinstance(self._conf.get(kind),dict):
+                conf.update(self._conf.get(kind))
+            policy = RetryPolicy(name,conf)
+            self._policies[name] = policy
+        return policy
+
+    def stats(self) -> dict:
+        return {name:p.stats() for name,p in self._policies.items() if p.retries or p.giveups}
+
+retry = RetryRegistry(RETRY)
@@ -0,0 +1,54 @@
+import asyncio
+import copy
+from util.metrics import metrics
+
+class SingleFlight():
+    """
+        合并相同的并发请求：同一个key同时只会有一个请求在飞，
+        其余调用者等待并共享同一个结果
+    """
+    def __init__(self) -> None:
+        self._calls = {}
+        self.shared = 0
+        metrics.register('singleflight',self.stats)
+
+    async def do(self,key,func):
+        """
+            key: 请求标识，func: 无参数，返回协程
+            请求在单独的任务里运行，发起者被取消时不影响其余等待的调用者
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            self.shared += 1
+            call[1] += 1
+            result = await asyncio.shield(call[0])
+            return self._copy(result)
+        task = asyncio.ensure_future(func())
+        call = [task,0]
+        self._calls[key] = call
+        task.add_done_callback(lambda _: self._done(key,call))
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            #没有共享者时请求一起取消，有共享者时请求继续，结果交给共享者
+            if not call[1]:
+                self._done(key,call)
+                task.cancel()
+            raise
+        #调用者可能会修改返回的数据(如edit前改data)，有共享者时各自拿副本
+        return self._copy(result) if call[1] else result
+
+    def _done(self,key,call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    @staticmethod
+    def _copy(result):
+        if isinstance(result,(dict,list)):
+            return copy.deepcopy(result)
+        return result
+
+    def stats(self) -> dict:
+        return {'inflight':len(self._calls),'shared':self.shared}
+
+singleflight = SingleFlight()
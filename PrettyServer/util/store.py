@@ -0,0 +1,219 @@
+import os
+import json
+import sys
+import sqlite3
+import time
+from conf.conf import DATA_PATH,PERSON_CACHE
+
+if DATA_PATH in ('default',None):
+    DATA_PATH = os.path.abspath(sys.path[0])
+
+_conn = None
+
+def connect() -> sqlite3.Connection:
+    """
+        所有持久化数据共用一个sqlite文件
+    """
+    global _conn
+    if _conn is None:
+        os.makedirs(DATA_PATH,exist_ok=True)
+        _conn = sqlite3.connect(os.path.join(DATA_PATH,'prettyserver.db'),
+                                check_same_thread=False,isolation_level=None)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+    return _conn
+
+class Store():
+    """
+        持久化基本类，子类在_init中建表
+    """
+    def __init__(self) -> None:
+        self.conn = connect()
+        self._init()
+
+    def _init(self):
+        pass
+
+class PersonCache(Store):
+    """
+        tmdb演员中文名缓存，chs为None表示确认没有中文名(负缓存)
+    """
+    def __init__(self,conf:dict) -> None:
+        #有中文名的缓存时间(天)
+        self.ttl = conf.get('ttl',90) * 86400
+        #没有中文名的缓存时间(天)，tmdb数据可能会补充，所以短一些
+        self.negative_ttl = conf.get('negative_ttl',14) * 86400
+        super().__init__()
+
+    def _init(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS person '
+                          '(tmdbid TEXT PRIMARY KEY, chs TEXT, updated REAL)')
+
+    def get(self,tmdbid):
+        """
+            返回(是否命中,中文名)
+        """
+        row = self.conn.execute('SELECT chs,updated FROM person WHERE tmdbid=?',
+                                (str(tmdbid),)).fetchone()
+        if row is None:
+            return False,None
+        chs,updated = row
+        ttl = self.ttl if chs else self.negative_ttl
+        if time.time() - updated > ttl:
+            return False,None
+        return True,chs
+
+    def set(self,tmdbid,chs:str=None):
+        self.conn.execute('INSERT OR REPLACE INTO person (tmdbid,chs,updated) VALUES (?,?,?)',
+                          (str(tmdbid),chs,time.time()))
+
+person_cache = PersonCache(PERSON_CACHE)
+
+class KeyValue(Store):
+    """
+        通用键值存储，值为json
+    """
+    def _init(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv '
+                          '(namespace TEXT, key TEXT, value TEXT, PRIMARY KEY(namespace,key))')
+
+    def get(self,namespace,key,default=None):
+        row = self.conn.execute('SELECT value FROM kv WHERE namespace=? AND key=?',
+                                (namespace,key)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self,namespace,key,value):
+        self.conn.execute('INSERT OR REPLACE INTO kv (namespace,key,value) VALUES (?,?,?)',
+                          (namespace,key,json.dumps(value)))
+
+    def delete(self,namespace,key=None):
+        if key is None:
+            self.conn.execute('DELETE FROM kv WHERE namespace=?',(namespace,))
+        else:
+            self.conn.execute('DELETE FROM kv WHERE namespace=? AND key=?',(namespace,key))
+
+class SyncJournal(Store):
+    """
+        同步任务已应用的事件记录：(任务,来源服务器,条目,动作,时间戳)，
+        重启或轮询重叠时同一个事件不会重复同步
+    """
+    def _init(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sync_journal '
+                          '(task TEXT, server TEXT, item TEXT, action TEXT, stamp TEXT, applied REAL, '
+                          'PRIMARY KEY(task,server,item,action,stamp))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS sync_journal_applied ON sync_journal (applied)')
+
+    def seen(self,task,server,item,action,stamp) -> bool:
+        row = self.conn.execute('SELECT 1 FROM sync_journal WHERE task=? AND server=? AND item=? '
+                                'AND action=? AND stamp=?',
+                                (task,server,str(item),action,str(stamp))).fetchone()
+        return row is not None
+
+    def record(self,task,server,item,action,stamp):
+        self.conn.execute('INSERT OR REPLACE INTO sync_journal VALUES (?,?,?,?,?,?)',
+                          (task,server,str(item),action,str(stamp),time.time()))
+
+    def trim(self,days:float):
+        self.conn.execute('DELETE FROM sync_journal WHERE applied<?',(time.time() - days * 86400,))
+
+class GuidIndex(Store):
+    """
+        单个服务器的刮削ID索引：(tmdb/imdb/tvdb, id) -> {条目id: 类型}
+        内存里保存一份，sqlite里持久化一份
+    """
+    PROVIDERS = ('tmdb','tvdb','imdb')
+
+    def __init__(self,server_name:str) -> None:
+        self.server = server_name
+        self._map = {}
+        super().__init__()
+        self.kv = KeyValue()
+        self._load()
+
+    def _init(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS guid_index '
+                          '(server TEXT, provider TEXT, pid TEXT, item TEXT, type TEXT, '
+                          'PRIMARY KEY(server,provider,pid,item))')
+
+    def _load(self):
+        rows = self.conn.execute('SELECT provider,pid,item,type FROM guid_index WHERE server=?',
+                                 (self.server,))
+        for provider,pid,item,type in rows:
+            self._map.setdefault((provider,pid),{})[item] = type
+
+    @staticmethod
+    def _norm(provider,pid):
+        if pid is None or pid == '':
+            return None
+        pid = str(pid)
+        #plex解析imdb时只保留了数字，统一成数字方便两边对上
+        if provider == 'imdb':
+            pid = ''.join(ch for ch in pid if ch.isdigit())
+        return pid or None
+
+    def _rows(self,item,type,ids:dict):
+        rows = []
+        for provider in self.PROVIDERS:
+            pid = self._norm(provider,ids.get(provider))
+            if pid:
+                rows.append((self.server,provider,pid,str(item),type))
+        return rows
+
+    def add(self,item,type,tmdb=None,imdb=None,tvdb=None):
+        rows = self._rows(item,type,{'tmdb':tmdb,'imdb':imdb,'tvdb':tvdb})
+        new = [r for r in rows if self._map.get((r[1],r[2]),{}).get(r[3]) != type]
+        if not new:
+            return
+        for _,provider,pid,item,type in new:
+            self._map.setdefault((provider,pid),{})[item] = type
+        self.conn.executemany('INSERT OR REPLACE INTO guid_index VALUES (?,?,?,?,?)',new)
+
+    def remove(self,item):
+        item = str(item)
+        for key in list(self._map.keys()):
+            self._map[key].pop(item,None)
+            if not self._map[key]:
+                del self._map[key]
+        self.conn.execute('DELETE FROM guid_index WHERE server=? AND item=?',(self.server,item))
+
+    def rebuild(self,items):
+        """
+            items: 可迭代的(条目id,类型,{'tmdb':..,'imdb':..,'tvdb':..})
+        """
+        rows = []
+        for item,type,ids in items:
+            rows += self._rows(item,type,ids)
+        self._map = {}
+        for _,provider,pid,item,type in rows:
+            self._map.setdefault((provider,pid),{})[item] = type
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.execute('DELETE FROM guid_index WHERE server=?',(self.server,))
+            self.conn.executemany('INSERT OR REPLACE INTO guid_index VALUES (?,?,?,?,?)',rows)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.kv.set('guid_index',self.server,time.time())
+
+    def lookup(self,tmdb=None,tvdb=None,imdb=None):
+        """
+            按tmdb，tvdb，imdb的顺序查找，返回[(条目id,类型)]
+        """
+        ids = {'tmdb':tmdb,'tvdb':tvdb,'imdb':imdb}
+        for provider in self.PROVIDERS:
+            pid = self._norm(provider,ids.get(provider))
+            if pid and self._map.get((provider,pid)):
+                return list(self._map[(provider,pid)].items())
+        return []
+
+    def age(self):
+        """
+            距离上次全量重建的秒数，从未重建返回None
+        """
+        built = self.kv.get('guid_index',self.server)
+        if built is None:
+            return None
+        return time.time() - built
@@ -0,0 +1,108 @@
+import asyncio
+import re
+from util.util import Util
+from util.batch import BatchLoader
+from util.retry import retry
+from util.limiter import limits
+from util.ratelimit import RequestScheduler,PRIORITY_BULK
+from util.exception import FailRequest
+from conf.conf import TMDB_API,PROXY,ISPROXY,TMDB_RATE
+
+BASE_URL = 'https://api.tmdb.org/3'
+#tmdb没有翻译时自动生成的季标题
+GENERIC_SEASON = re.compile(r'^\s*(第\s*\d+\s*季|Season\s*\d+|特别篇|Specials)\s*$',re.I)
+
+class Tmdb(Util):
+    """
+        tmdb请求层：同一时间段内对同一个条目的子请求(季，演员表...)
+        合并到一次append_to_response请求里，每次最多20个
+    """
+    MAX_APPEND = 20
+
+    def __init__(self,session) -> None:
+        self.session = session
+        self.proxy = PROXY if ISPROXY else None
+        #所有tmdb请求按固定速率排队发出，不和plex，emby共用并发数
+        self.scheduler = RequestScheduler('tmdb',TMDB_RATE.get('rps',10),TMDB_RATE.get('burst'))
+        #key: (tv/movie, tmdbid, 语言, 子请求)
+        self.loader = BatchLoader('tmdb_append',self._plan,size=200)
+        #(tv/movie, tmdbid, 语言) -> 等待中的最高优先级
+        self._priority = {}
+
+    async def get(self,url,errors:dict=None,msg:str=None,priority:int=PRIORITY_BULK):
+        return await self.scheduler.submit(url,lambda: self._request(self.session,'GET',url,
+                                           retry.policy('tmdb','tmdb'),limits.limiter('tmdb','tmdb'),
+                                           msg=msg,errors=errors,proxy=self.proxy),priority)
+
+    async def _plan(self,keys:list):
+        """
+            按条目分组，每组拆成不超过MAX_APPEND个子请求的请求
+        """
+        groups = {}
+        for key in keys:
+            kind,tmdbid,language,sub = key
+            groups.setdefault((kind,tmdbid,language),[]).append(sub)
+        requests = []
+        priorities = {}
+        for title,subs in groups.items():
+            priorities[title] = self._priority.pop(title,PRIORITY_BULK)
+            for n in range(0,len(subs),self.MAX_APPEND):
+                requests.append((title,subs[n:n+self.MAX_APPEND]))
+        replies = await asyncio.gather(*[self._fetch(title,subs,priorities[title]) for title,subs in requests],
+                                       return_exceptions=True)
+        result = {}
+        for (title,subs),reply in zip(requests,replies):
+            for sub in subs:
+                if isinstance(reply,BaseException):
+                    #单个条目失败不影响其它条目，异常交给调用者
+                    result[title + (sub,)] = reply
+                else:
+                    result[title + (sub,)] = reply.get(sub)
+        return result
+
+    async def _fetch(self,title,subs:list,priority:int):
+        kind,tmdbid,language = title
+        url = (f'{BASE_URL}/{kind}/{tmdbid}?api_key={TMDB_API}&language={language}'
+               f'&append_to_response={",".join(subs)}')
+        return await self.get(url,errors={404:"TMDBID 不存在"},msg="获取tmdb数据失败",priority=priority)
+
+    async def append(self,kind:str,tmdbid,sub:str,language:str='zh-CN',priority:int=PRIORITY_BULK):
+        """
+            kind: tv或movie，sub: append_to_response的子请求，如credits，season/1
+        """
+        title = (kind,str(tmdbid),language)
+        self._priority[title] = min(priority,self._priority.get(title,priority))
+        result = await self.loader.load(title + (sub,))
+        if isinstance(result,BaseException):
+            raise result
+        return result
+
+    async def season_titles(self,series_id,season_numbers,priority:int=PRIORITY_BULK) -> dict:
+        """
+            返回{季数: 简体中文季标题}，没有的为None；所有季合并成一两次请求，
+            zh-CN的season/N标题就是CN的翻译，tmdb自动生成的"第 N 季"不算
+        """
+        numbers = list(season_numbers)
+        seasons = await asyncio.gather(*[self.append('tv',series_id,f'season/{n}',priority=priority) for n in numbers])
+        titles = {}
+        for n,season in zip(numbers,seasons):
+            name = (season or {}).get('name')
+            #没有zh-CN翻译时tmdb返回默认语言的标题或自动生成的"第 N 季"
+            if name and any('\u4e00' <= ch <= '\u9fff' for ch in name) \
+                    and self.issimple(name) and not GENERIC_SEASON.match(name):
+                titles[n] = name
+            else:
+                titles[n] = None
+        return titles
+
+    async def credits(self,type:str,tmdbid,priority:int=PRIORITY_BULK):
+        if type == "tv":
+            sub = 'aggregate_credits'
+        elif type == "movie":
+            sub = 'credits'
+        else:
+            raise FailRequest("Type 参数错误，只支持tv，movie")
+        data = await self.append(type,tmdbid,sub,priority=priority)
+        if data is None:
+            raise FailRequest("获取演员列表失败")
+        return data
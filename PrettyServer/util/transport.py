@@ -0,0 +1,52 @@
+import aiohttp
+from conf.conf import TRANSPORT
+
+class Transport():
+    """
+        连接池管理：每个上游(plex,emby,tmdb,douban)共用一个调优过的连接器
+    """
+    def __init__(self,conf:dict) -> None:
+        #总连接数上限
+        self.limit = conf.get('limit',100)
+        #单个主机连接数上限
+        self.limit_per_host = conf.get('limit_per_host',20)
+        #keep-alive保持时间(秒)
+        self.keepalive = conf.get('keepalive',60)
+        #dns缓存时间(秒)
+        self.dns_ttl = conf.get('dns_ttl',300)
+        #请求超时(秒)
+        self.timeout = conf.get('timeout',60)
+        self.connect_timeout = conf.get('connect_timeout',10)
+        self._sessions = {}
+
+    def session(self,name:str,stream:bool=False) -> aiohttp.ClientSession:
+        """
+            name: 上游名称，同名上游复用同一个session
+            stream: 长连接(websocket)用，不设总超时，否则连接到时间就会被断开
+        """
+        key = f'{name}#stream' if stream else name
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive,
+                                             ttl_dns_cache=self.dns_ttl,
+                                             use_dns_cache=True,
+                                             enable_cleanup_closed=True)
+            timeout = aiohttp.ClientTimeout(total=None if stream else self.timeout,
+                                            sock_connect=self.connect_timeout)
+            session = aiohttp.ClientSession(connector=connector,timeout=timeout)
+            self._sessions[key] = session
+        return session
+
+    async def close(self,name:str=None):
+        if name is None:
+            names = list(self._sessions.keys())
+        else:
+            names = [name,f'{name}#stream']
+        for n in names:
+            session = self._sessions.pop(n,None)
+            if session and not session.closed:
+                await session.close()
+
+transport = Transport(TRANSPORT)
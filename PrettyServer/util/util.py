@@ -1,10 +1,17 @@
+import asyncio
+import datetime
 import opencc
 import time as Time
 from util.exception import FailRequest
-from aiohttp import ContentTypeError
-from aiohttp import ClientSession
-from util.exception import FailRequest
-from conf.conf import TMDB_API,PROXY,ISPROXY
+from aiohttp import ContentTypeError,ClientConnectionError
+from util.log import log
+from util.retry import retry,RETRY_STATUS
+from util.limiter import limits
+from util.singleflight import singleflight
+from util.store import person_cache
+from util.transport import transport
+from util.ratelimit import PRIORITY_BULK
+from conf.conf import TMDB_API
 
 class Util():
     def bulidurl(self,url,payload:dict=None):
@@ -92,6 +99,15 @@ class Util():
         elif self._server.type == 'emby':
             return f'S{str(self.ParentIndexNumber).zfill(2)}E{str(self.IndexNumber).zfill(2)}'
 
+    def episode_key(self):
+        """
+            (季数, 集数)，用于两边的集匹配
+        """
+        if self._server.type == 'plex':
+            return (self.parentIndex,self.index)
+        elif self._server.type == 'emby':
+            return (self.ParentIndexNumber,self.IndexNumber)
+
     async def _fetchitem(self,ekey):
         """
             ekey : ratingKey
@@ -99,58 +115,81 @@ class Util():
         if self._server.type == 'plex':
             path_url = f'/library/metadata/{ekey}'
         elif self._server.type == 'emby':
-            path_url = f'/Users/{self._server.userid}/Items/{ekey}'
+            #emby通过批量加载，同一时间段的单个请求合并成一个
+            data = await self._server.itemloader.load(ekey)
+            if data is None:
+                raise FailRequest('请求失败，请检查网络或ekey',404)
+            return data
         data = await self._server.query(path_url,msg='请求失败，请检查网络或ekey')
         return data
 
+    async def _request(self, session, method, url, policy, limiter, msg:str=None, errors:dict=None, **kwargs):
+        """
+            统一请求入口：每次请求占用limiter的一个并发名额，非2xx按policy重试，errors为状态码对应的报错信息
+        """
+        attempt = 0
+        while True:
+            retry_after = None
+            await limiter.acquire()
+            start = Time.monotonic()
+            #None表示结果与上游状态无关(如被取消)，不参与并发数调整
+            healthy = None
+            try:
+                async with session.request(method,url,**kwargs) as res:
+                    if res.status in (200, 201, 204):
+                        healthy = True
+                        try:
+                            return await res.json()
+                        except ContentTypeError:
+                            return res
+                    status = res.status
+                    healthy = status not in RETRY_STATUS
+                    retry_after = res.headers.get('Retry-After')
+            except (ClientConnectionError, asyncio.TimeoutError):
+                healthy = False
+                if not policy.should_retry(attempt,method=method):
+                    raise
+                status = None
+            else:
+                if not policy.should_retry(attempt,status,method):
+                    if errors and status in errors:
+                        raise FailRequest(errors[status],status)
+                    raise FailRequest(msg,status)
+            finally:
+                limiter.release(Time.monotonic() - start,healthy)
+            policy.record(status)
+            wait = policy.delay(attempt,retry_after)
+            log.debug(f'{method} {url} 状态{status}，{wait:.1f}秒后第{attempt+1}次重试')
+            await asyncio.sleep(wait)
+            attempt += 1
+
     async def query(self, path, method=None, headers=None, data=None, json=None,msg:str=None):
         url = self.url + path
         header = self.header
         if not hasattr(self,'session'):
-            self.session = ClientSession()
+            self.session = transport.session(self.url)
         if headers:         
             header.update(headers)
-        if method is not None:
-            if method.upper() == 'POST':
-                async with self.session.post(url,headers=header,data=data,json=json) as res:
-                    if res.status in (200, 201, 204):
-                        try:
-                            data = await res.json()
-                        except ContentTypeError:
-                            data = res
-                    else:
-                        raise FailRequest(msg)
-                #headers.update({'Content-type': 'application/x-www-form-urlencoded'})
-            elif method.upper() == 'PUT':
-                async with self.session.put(url,headers=header) as res:
-                    if res.status in (200, 201, 204):
-                        try:
-                            data = await res.json()
-                        except ContentTypeError:
-                            data = res
-                    else:
-                        raise FailRequest(msg)
-            elif method.upper() == 'DELETE':
-                async with self.session.delete(url,headers=header) as res:
-                    if res.status in (200, 201, 204):
-                        try:
-                            data = await res.json()
-                        except ContentTypeError:
-                            data = res
-                    else:
-                        raise FailRequest(msg)
-            else:
-                #print("Invalid request method provided: {method}".format(method=method))
-                return
+        if method is None:
+            method = 'GET'
+        method = method.upper()
+        if method == 'POST':
+            kwargs = {'data':data,'json':json}
+            #headers.update({'Content-type': 'application/x-www-form-urlencoded'})
+        elif method in ('GET','PUT','DELETE'):
+            kwargs = {}
         else:
-            async with self.session.get(url,headers=header) as res:
-                if res.status in (200, 201, 204):
-                    try:
-                        data = await res.json()
-                    except ContentTypeError:
-                        data = res
-                else:
-                    raise FailRequest(msg)
+            #print("Invalid request method provided: {method}".format(method=method))
+            return
+        policy = retry.policy(self.url,getattr(self,'type',None))
+        limiter = limits.limiter(self.url,getattr(self,'type',None))
+        if method == 'GET':
+            #相同的并发GET只发一次
+            key = (url,tuple(sorted(header.items())))
+            data = await singleflight.do(key,lambda: self._request(self.session,method,url,policy,limiter,
+                                                                   msg=msg,headers=dict(header)))
+        else:
+            data = await self._request(self.session,method,url,policy,limiter,msg=msg,headers=header,**kwargs)
         #log.debug('%s %s', method.__name__.upper(), url)
         return data
     
@@ -160,7 +199,8 @@ class Util():
             await self._server.query(path,msg='请求错误，调整已观看失败')
         elif self._server.type == 'emby':
             path = f'/Users/{self._server.userid}/PlayedItems/{self.Id}'
-            await self._server.query(path,method='post',msg='请求错误，调整已观看失败')
+            data = await self._server.query(path,method='post',msg='请求错误，调整已观看失败')
+            self._set_userdata({'Played':True,'PlaybackPositionTicks':0},data)
 
     async def unwatched(self):
         if self._server.type == 'plex':
@@ -171,87 +211,84 @@ class Util():
             await self._server.query(path,method='post',msg='请求错误，调整未观看失败')
 
     async def timeline(self,time):
-        now_str = str(Time.time()).replace('.','')
         if self._server.type == 'plex':
             path = f'/:/timeline?ratingKey={self.ratingKey}&key={self.key}&identifier=com.plexapp.plugins.library&time={time}&state=stopped&duration={self.duration}'
             await self._server.query(path,msg='请求错误，调整观看进度失败')
         elif self._server.type == 'emby':
-            path = f'/Sessions/Playing'
-            payload = {
-                'ItemId':self.Id,
-                'PositionTicks': time,
-                'PlaybackStartTimeTicks':now_str
-                }
-            await self._server.query(path,method='post',json=payload,msg='请求错误，调整观看开始时间失败')
+            #直接写入用户数据，不模拟播放会话
+            now = datetime.datetime.utcnow()
             payload = {
-                'ItemId':self.Id,
-                'PositionTicks': time,
-                'PlaybackStartTimeTicks':now_str
+                'PlaybackPositionTicks': time,
+                'LastPlayedDate': now.isoformat(timespec='milliseconds') + 'Z'
                 }
-            path = f'/Sessions/Playing/Stopped'
-            await self._server.query(path,method='post',json=payload,msg='请求错误，调整观看进度失败')
+            #只改进度，保留原来的已观看状态
+            if getattr(self,'Played',None) is not None:
+                payload['Played'] = self.Played
+            path = f'/Users/{self._server.userid}/Items/{self.Id}/UserData'
+            data = await self._server.query(path,method='post',json=payload,msg='请求错误，调整观看进度失败')
+            self._set_userdata(payload,data,now)
 
-    async def get_chs_name(self,cid):
+    def _set_userdata(self,sent:dict,data=None,now:datetime.datetime=None):
+        """
+            emby：写入观看数据后就地更新条目，不用再reload，
+            以服务器返回的UserData为准，没有返回时用写入的值
+        """
+        userdata = dict(getattr(self,'UserData',None) or {})
+        userdata.update(sent)
+        if isinstance(data,dict):
+            userdata.update(data)
+        self.UserData = userdata
+        self.Played = userdata.get('Played')
+        self.PlaybackPositionTicks = userdata.get('PlaybackPositionTicks')
+        #和emby返回的LastPlayedDate一样为不带时区的utc时间
+        self.LastPlayedDate = now or datetime.datetime.utcnow()
+
+    async def _tmdb_get(self,url,errors:dict=None,msg:str=None,priority:int=PRIORITY_BULK):
+        return await self._server.tmdb.get(url,errors=errors,msg=msg,priority=priority)
+
+    async def get_chs_name(self,cid,priority:int=PRIORITY_BULK):
+        hit,chs = person_cache.get(cid)
+        if hit:
+            return {'chs':chs}
         url = f'https://api.tmdb.org/3/person/{cid}?api_key={TMDB_API}&language=zh-CN'
-        proxy = PROXY if ISPROXY else None
-        async with self._server.tmdb_session.get(url,proxy=proxy) as res:
-            if res.status == 200:
-                respond =  await res.json()
-                data = {}
-                data[respond['name']] = {}
-                data[respond['name']]['id'] = respond['id']
-                data[respond['name']]['also_known_as'] = respond['also_known_as']
-                if respond['also_known_as']:
-                    for chs_name in respond['also_known_as']:
-                        if self.check_chs(chs_name):
-                            if self.issimple(chs_name):
-                                data[respond['name']]['chs'] = chs_name
-                                break
-                            else:
-                                data[respond['name']]['chs'] = None
-                        else:
-                            data[respond['name']]['chs'] = None
+        try:
+            respond = await self._tmdb_get(url,errors={404:"演员CID 不存在"},msg="获取演员中文名失败",
+                                           priority=priority)
+        except FailRequest as e:
+            if e.status == 404:
+                person_cache.set(cid,None)
+            raise
+        data = {}
+        data[respond['name']] = {}
+        data[respond['name']]['id'] = respond['id']
+        data[respond['name']]['also_known_as'] = respond['also_known_as']
+        if respond['also_known_as']:
+            for chs_name in respond['also_known_as']:
+                if self.check_chs(chs_name):
+                    if self.issimple(chs_name):
+                        data[respond['name']]['chs'] = chs_name
+                        break
+                    else:
+                        data[respond['name']]['chs'] = None
                 else:
                     data[respond['name']]['chs'] = None
-            elif res.status == 404:
-                raise FailRequest("演员CID 不存在")
-            else: 
-                raise FailRequest("获取演员中文名失败")
+        else:
+            data[respond['name']]['chs'] = None
+        person_cache.set(cid,data[respond['name']]['chs'])
         return {'chs':data[respond['name']]['chs']}
     
-    async def season_title(self,series_id,season_number):
-        path = f"https://api.tmdb.org/3/tv/{series_id}/season/{season_number}/translations?api_key={TMDB_API}"
-        proxy = PROXY if ISPROXY else None
-        async with self._server.tmdb_session.get(path,proxy=proxy) as res:
-            if res.status == 200:
-                respond =  await res.json()
-                for trans in respond.get("translations"):
-                    if trans.get("iso_3166_1") == "CN":
-                        if trans["data"].get("name"):
-                            return trans["data"].get("name")
-                        else:
-                            return None
-            if res.status == 404:
-                raise FailRequest("TMDBID或者季数 不存在")
-            else:
-                raise FailRequest("获取季标题失败")
+    async def season_title(self,series_id,season_number,priority:int=PRIORITY_BULK):
+        titles = await self._server.tmdb.season_titles(series_id,[season_number],priority)
+        return titles.get(season_number)
 
-    async def get_role_from_id(self,type,tmdbid):
+    async def season_titles(self,series_id,season_numbers,priority:int=PRIORITY_BULK):
+        """
+            一次取回剧集所有季的中文标题：{季数: 标题}
+        """
+        return await self._server.tmdb.season_titles(series_id,season_numbers,priority)
+
+    async def get_role_from_id(self,type,tmdbid,priority:int=PRIORITY_BULK):
         """
             type: movie for movie, tv for tv
         """
-        if type == "tv":
-            url = f'https://api.tmdb.org/3/tv/{tmdbid}/aggregate_credits?api_key={TMDB_API}&language=zh-CN'
-        elif type == "movie":
-            url = f'https://api.tmdb.org/3/movie/{tmdbid}/credits?api_key={TMDB_API}&language=zh-CN'
-        else:
-            raise FailRequest("Type 参数错误，只支持tv，movie")
-        proxy = PROXY if ISPROXY else None
-        async with self._server.tmdb_session.get(url,proxy=proxy) as res:
-            if res.status == 200:
-                tmdb_data = await res.json()
-                return tmdb_data
-            if res.status == 404:
-                raise FailRequest("TMDBID 不存在")
-            else:
-                raise FailRequest("获取演员列表失败")
\ No newline at end of file
+        return await self._server.tmdb.credits(type,tmdbid,priority)
@@ -0,0 +1,84 @@
+import traceback
+from util.log import log
+from util.metrics import metrics
+
+class WriteQueue():
+    """
+        写缓冲：同一个(服务器,条目)只保留事件时间最新的写入，时间相同时已观看优先；
+        flush时按优先级写入，已观看在前
+    """
+    #数字小的先写
+    PRIORITY = {'watched':0,'timeline':1}
+
+    def __init__(self,name:str) -> None:
+        self.name = name
+        #key: [优先级, 序号, 动作, 写入函数, 名称, 事件时间, [成功回调], [失败回调]]
+        self._pending = {}
+        self._seq = 0
+        #本轮被合并掉的写入
+        self._collapsed = []
+        #统计
+        self.queued = 0
+        self.collapsed = 0
+        self.written = 0
+        self.failed = 0
+        metrics.register(f'writes.{name}',self.stats)
+
+    def put(self,key,action:str,write,label:str=None,stamp:float=0,done=None,failed=None):
+        """
+            write: async def write()，stamp: 事件时间(时间戳)
+            done/failed: 写入成功/失败后调用，被合并的写入的回调跟随最终写入一起调用
+        """
+        self.queued += 1
+        self._seq += 1
+        dones = [done] if done else []
+        faileds = [failed] if failed else []
+        entry = self._pending.get(key)
+        if entry is not None:
+            if (stamp,action == 'watched') <= (entry[5],entry[2] == 'watched'):
+                #已有的写入更新，丢弃这次的
+                entry[6] += dones
+                entry[7] += faileds
+                self._collapse(label,action)
+                return
+            dones = entry[6] + dones
+            faileds = entry[7] + faileds
+            self._collapse(entry[4],entry[2])
+        self._pending[key] = [self.PRIORITY[action],self._seq,action,write,label,stamp,dones,faileds]
+
+    def _collapse(self,label,action):
+        self.collapsed += 1
+        self._collapsed.append(f'{label}({action})')
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def flush(self) -> int:
+        """
+            写入全部缓冲，返回失败的个数
+        """
+        entries = sorted(self._pending.values(),key=lambda e: (e[0],e[1]))
+        self._pending = {}
+        if self._collapsed:
+            log.info(f'{self.name}：合并了{len(self._collapsed)}个重复写入，实际写入{len(entries)}个')
+            log.debug(f'{self.name}：被合并的写入：{"，".join(self._collapsed)}')
+            self._collapsed = []
+        failed = 0
+        for _,_,action,write,label,_,dones,faileds in entries:
+            try:
+                await write()
+            except Exception:
+                failed += 1
+                log.error(f'{label}写入失败 ：\n {traceback.format_exc()}')
+                for callback in faileds:
+                    callback()
+                continue
+            self.written += 1
+            for callback in dones:
+                callback()
+        self.failed += failed
+        return failed
+
+    def stats(self) -> dict:
+        return {'queued':self.queued,'collapsed':self.collapsed,'written':self.written,
+                'failed':self.failed,'pending':len(self._pending)}